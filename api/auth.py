@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+
+def cache_directory():
+    """Directory holding everything identity-graph keeps between runs"""
+    return Path(os.getenv('IDENTITY_GRAPH_CACHE', Path.home() / '.identity-graph'))
+
+
+class TokenCache:
+    """Keep the resolved Identity URL and the platform token on disk until the token expires.
+
+    Entries are stored in one file per tenant and client, readable by the owner only (0600)."""
+
+    def __init__(self, subdomain, client_id, client_secret, directory=None, platform_url=None):
+        if directory is None:
+            directory = cache_directory() / 'tokens'
+        self.directory = Path(directory)
+        # Changing the secret must not reuse a token obtained with the previous one, nor changing the platform
+        # the Identity URL discovered from another one, eg: a mock platform restarted on a new port
+        key = f'{subdomain}:{client_id}:{client_secret}'
+        if platform_url is not None:
+            key = f'{key}:{platform_url}'
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        self.path = self.directory / f'{key}.json'
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def update(self, **fields):
+        entry = self.load()
+        entry.update(fields)
+        try:
+            self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(entry, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f'Unable to cache token in {self.path}: {e}')
+
+    def token(self, margin=0):
+        """Return the cached (access_token, expires_at) if it is still valid for `margin` seconds"""
+        entry = self.load()
+        if 'access_token' not in entry or entry.get('expires_at', 0) - margin <= time.time():
+            return None, 0
+        return entry['access_token'], entry['expires_at']
+
+    def clear(self):
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
@@ -1,120 +1,487 @@
+import asyncio
 import base64
 import logging
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 
 import aiohttp
-import requests
+
+from api.auth import TokenCache
+from api.errors import RequestError
+from api.metrics import Metrics, endpoint
+
+
+class TokenBucket:
+    """Allow at most `rate` requests per second, with bursts up to one second of requests. Without a rate
+    requests are only held while the bucket is paused"""
+
+    def __init__(self, rate=None):
+        self.rate = None
+        self.capacity = None
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        if rate is not None and self.rate is None:
+            # A bucket limited while requests are in progress starts empty rather than with a burst
+            self.tokens = 0
+            self.updated_at = time.monotonic()
+        self.rate = rate
+        self.capacity = None if rate is None else max(1.0, rate)
+        if rate is not None:
+            self.tokens = min(self.tokens, self.capacity)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.rate is None:
+                return
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, delay):
+        """Hold every request to the host, eg: when the server sent a Retry-After header"""
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+class HostLimiter:
+    """Per-host AIMD concurrency limit and request rate.
+
+    The concurrency limit grows by one request per round trip while the latency of each endpoint stays close to the
+    best latency observed on that endpoint, so slow but normal calls such as large pages are not taken for
+    congestion, and is cut by half when the host throttles us. The request rate is only capped by max_rate until the
+    host still throttles us at the minimum concurrency: it is then cut by half and grows back by rate_increase
+    requests per second every second. The concurrency limit is cut at most once per round trip, as responses to
+    requests sent before a cut do not reflect it yet, and the rate at most once per rate_window seconds, as hosts
+    count our requests over such windows"""
+
+    latency_tolerance = 2.0
+    decrease_factor = 0.5
+    rate_increase = 5.0
+    rate_window = 1.0
+    min_rate = 1.0
+
+    def __init__(self, max_concurrency, max_rate=None, min_concurrency=1):
+        self.bucket = TokenBucket(max_rate)
+        self.max_rate = max_rate
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(max_concurrency, max(min_concurrency, max_concurrency // 4)))
+        self.in_flight = 0
+        # Endpoint -> best latency observed, see api.metrics.endpoint()
+        self.best_latency = {}
+        self.decreased_at = 0
+        self.rate_decreased_at = 0
+        # Send times of the last second, to know the rate to cut when the host throttles an unlimited bucket
+        self.sent = deque()
+        self.waiters = deque()
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+        else:
+            # Waiters are admitted one by one in FIFO order, the slot is taken on their behalf by __admit()
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                else:
+                    self.waiters.remove(waiter)
+                raise
+        try:
+            await self.bucket.acquire()
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+        now = time.monotonic()
+        self.sent.append(now)
+        while self.sent[0] < now - 1:
+            self.sent.popleft()
+
+    def release(self):
+        self.in_flight -= 1
+        self.__admit()
+
+    def __admit(self):
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def __decrease(self, started_at):
+        """Return True when a request sent at started_at may cut the concurrency limit, once per round trip"""
+        if started_at < self.decreased_at:
+            return False
+        self.decreased_at = time.monotonic()
+        return True
+
+    def on_success(self, endpoint, started_at, latency):
+        best_latency = self.best_latency.get(endpoint)
+        if best_latency is None or latency < best_latency:
+            self.best_latency[endpoint] = best_latency = latency
+
+        if latency > best_latency * self.latency_tolerance + 0.05:
+            # The host is queueing our requests, back off gently
+            if self.__decrease(started_at):
+                self.limit = max(self.min_concurrency, self.limit * 0.9)
+            return
+
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        if self.bucket.rate is not None:
+            rate = self.bucket.rate + self.rate_increase / self.bucket.rate
+            self.bucket.set_rate(rate if self.max_rate is None else min(self.max_rate, rate))
+        self.__admit()
+
+    def on_throttle(self, started_at, retry_after=None):
+        if retry_after is not None:
+            self.bucket.pause(retry_after)
+        if self.limit > self.min_concurrency:
+            if self.__decrease(started_at):
+                self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+            return
+
+        # Fewer requests in flight cannot slow us down any more, the host limits our rate
+        now = time.monotonic()
+        if now - self.rate_decreased_at < self.rate_window:
+            return
+        self.rate_decreased_at = now
+        rate = self.bucket.rate if self.bucket.rate is not None else len(self.sent)
+        self.bucket.set_rate(max(self.min_rate, rate * self.decrease_factor))
+
+
+class RequestScheduler:
+    """Rate limit, retry and adapt concurrency of the requests sent to each host"""
+
+    retry_status_codes = [408, 425, 429, 500, 502, 503, 504]
+    throttle_status_codes = [429, 503]
+
+    def __init__(self, max_concurrency=20, max_rate=None, max_retries=6, backoff_base=0.5, backoff_max=60,
+                 metrics=None):
+        self.max_concurrency = max_concurrency
+        # Requests per second never exceeded on a host, None to only limit the rate once the host throttles us
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hosts = {}
+        # Every attempt is recorded there when set
+        self.metrics = metrics
+
+    def host(self, url):
+        netloc = urlparse(url).netloc
+        if netloc not in self.hosts:
+            self.hosts[netloc] = HostLimiter(self.max_concurrency, self.max_rate)
+        return self.hosts[netloc]
+
+    def backoff(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def body_size(data):
+        if isinstance(data, str):
+            return len(data.encode('utf-8'))
+        if isinstance(data, (bytes, bytearray)):
+            return len(data)
+        return 0
+
+    @staticmethod
+    def retry_after(response):
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    async def request(self, session, method, url, **kwargs):
+        limiter = self.host(url)
+        _, path = endpoint(url)
+        bytes_sent = self.body_size(kwargs.get('data'))
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            started_at = time.monotonic()
+            try:
+                response = await session.request(method, url, **kwargs)
+                # Read the body now so the connection goes back to the pool before the next attempt
+                body = await response.read()
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                limiter.release()
+                if self.metrics is not None:
+                    self.metrics.request(method, url, None, time.monotonic() - started_at, bytes_sent,
+                                         retry=attempt > 0)
+                if attempt >= self.max_retries:
+                    raise RequestError(url, None, str(e)) from e
+                delay = self.backoff(attempt)
+                logging.debug(f'Request to {url} failed ({e}), retrying in {delay:.2f}s')
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except asyncio.CancelledError:
+                # Cancelled by a failed sibling request or 'scan stop', the slot goes to the next request
+                limiter.release()
+                raise
+            limiter.release()
+            if self.metrics is not None:
+                self.metrics.request(method, url, response.status, time.monotonic() - started_at, bytes_sent,
+                                     len(body), retry=attempt > 0,
+                                     throttled=response.status in self.throttle_status_codes)
+
+            if response.status not in self.retry_status_codes:
+                limiter.on_success((method, path), started_at, time.monotonic() - started_at)
+                return response
+
+            retry_after = self.retry_after(response)
+            if retry_after is not None and retry_after > self.backoff_max:
+                # A far Retry-After (eg: a date hours ahead) would stall the host's requests, wait backoff_max at most
+                logging.debug(f'Retry-After of {url} is {retry_after:.0f}s, waiting {self.backoff_max}s instead')
+                retry_after = self.backoff_max
+            if response.status in self.throttle_status_codes:
+                limiter.on_throttle(started_at, retry_after)
+
+            if attempt >= self.max_retries:
+                return response
+
+            delay = retry_after if retry_after is not None else self.backoff(attempt)
+            logging.debug(f'Request to {url} returned {response.status}, retrying in {delay:.2f}s')
+            await asyncio.sleep(delay)
+            attempt += 1
+
 
 class OAuthClient:
     http_success_codes = [200, 201, 202, 203, 204, 205, 206, 207, 208, 210, 226]
+    # Refresh the token when it has less than this many seconds left
+    refresh_margin = 120
 
-    def __init__(self, oauth_endpoint, client_id, client_secret, scope=None):
+    def __init__(self, oauth_endpoint, client_id, client_secret, scope=None, pool_size=100, pool_per_host=20,
+                 keepalive_timeout=30, host_rate=None, max_retries=6, token_cache=None):
         self.oauth_endpoint = oauth_endpoint
         self.auth_token = base64.b64encode((client_id + ':' + client_secret).encode('utf-8')).decode('utf-8')
         self.scope = scope
-        self.login()
+        self.token_cache = token_cache
+        self.access_token = None
+        self.expires_at = 0
 
-        self.session = requests.Session()
+        # Connection pool shared by every service, opened for the lifetime of an event loop
+        self.pool_size = pool_size
+        self.pool_per_host = pool_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.async_session = None
 
-    def login(self):
-        url = f'{self.oauth_endpoint}'
-        data ={'grant_type': 'client_credentials'}
-        if self.scope is not None:
-            data['scope'] = self.scope
+        self.host_rate = host_rate
+        self.max_retries = max_retries
+        self.scheduler = None
+        # Requests and service phases of the scans, see 'stats'
+        self.metrics = Metrics()
+
+        self.refresh_lock = None
+        self.refresh_task = None
 
-        request = requests.post(
-            url,
-            data=data,
-            headers={'Authorization': f'Basic {self.auth_token}'}
+    async def open(self):
+        """Open the shared aiohttp session, connections are kept alive and reused across requests"""
+        if self.async_session is not None and not self.async_session.closed:
+            return self.async_session
+
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_per_host,
+            keepalive_timeout=self.keepalive_timeout,
         )
+        self.async_session = aiohttp.ClientSession(connector=connector)
+        # Limiters and locks hold asyncio primitives, they belong to the same event loop as the session
+        self.scheduler = RequestScheduler(self.pool_per_host, self.host_rate, self.max_retries, metrics=self.metrics)
+        self.refresh_lock = asyncio.Lock()
+        self.refresh_task = asyncio.create_task(self.__refresh_loop())
+        return self.async_session
 
-        if request.status_code != 200:
-            logging.error(f'Request to {url} failed')
-            logging.error(f'Error code: {request.status_code}')
-            logging.error(f'Content: {request.content}')
-            exit(1)
-        self.access_token = request.json()['access_token']
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+        self.refresh_task = None
 
+        if self.async_session is not None:
+            await self.async_session.close()
+        self.async_session = None
 
-    def get(self, url, headers=None):
-        if headers is None:
-            headers = {}
+    async def __aenter__(self):
+        await self.open()
+        return self
 
-        if not 'Authorization' in headers:
-            headers['Authorization'] = f'Bearer {self.access_token}'
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
-        request = self.session.get(url, headers=headers)
-        if request.status_code not in self.http_success_codes:
-            logging.error(f'Request to {url} failed')
-            logging.error(f'Error code: {request.status_code}')
-            logging.error(f'Content: {request.content}')
-            exit(1)
+    async def login(self):
+        """Get a platform token, from the cache when it is still valid"""
+        if self.token_cache is not None:
+            self.access_token, self.expires_at = self.token_cache.token(self.refresh_margin)
+            if self.access_token is not None:
+                logging.debug('Using cached platform token')
+                return
 
-        return request
+        if self.async_session is not None and not self.async_session.closed:
+            await self.__fetch_token(self.async_session)
+            return
 
+        async with aiohttp.ClientSession() as session:
+            await self.__fetch_token(session)
 
-    def post(self, url, data=None, headers=None):
-        if headers is None:
-            headers = {}
+    async def __fetch_token(self, session):
+        url = f'{self.oauth_endpoint}'
+        data ={'grant_type': 'client_credentials'}
+        if self.scope is not None:
+            data['scope'] = self.scope
 
-        if not 'Authorization' in headers:
-            headers['Authorization'] = f'Bearer {self.access_token}'
+        async with session.post(url, data=data, headers={'Authorization': f'Basic {self.auth_token}'}) as request:
+            if request.status != 200:
+                raise RequestError(url, request.status, await request.text())
+            token_data = await request.json()
 
-        request = self.session.post(url, headers=headers, data=data)
-        if request.status_code not in self.http_success_codes:
-            logging.error(f'Request to {url} failed')
-            logging.error(f'Error code: {request.status_code}')
-            logging.error(f'Content: {request.content}')
-            exit(1)
+        self.access_token = token_data['access_token']
+        self.expires_at = time.time() + int(token_data.get('expires_in', 3600))
+        if self.token_cache is not None:
+            self.token_cache.update(access_token=self.access_token, expires_at=self.expires_at)
 
-        return request
+    async def token(self):
+        """Return a valid access token, waiting for a refresh in progress if any"""
+        if self.access_token is None or self.expires_at - self.refresh_margin <= time.time():
+            await self.refresh(self.access_token)
+        return self.access_token
+
+    async def refresh(self, stale_token):
+        """Replace stale_token, requests that find a refresh in progress wait for it instead of refreshing again"""
+        async with self.refresh_lock:
+            if self.access_token != stale_token:
+                return
+            logging.debug('Refreshing platform token')
+            await self.__fetch_token(await self.open())
 
-    async def aget(self, session, url, headers=None):
+    async def __refresh_loop(self):
+        while True:
+            await asyncio.sleep(max(1, self.expires_at - self.refresh_margin - time.time()))
+            try:
+                await self.refresh(self.access_token)
+            except (RequestError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Requests will try again on their own when the token is about to expire
+                logging.warning(f'Failed to refresh platform token: {e}')
+                await asyncio.sleep(10)
+
+    async def arequest(self, method, url, data=None, headers=None):
         if headers is None:
             headers = {}
 
-        if not 'Authorization' in headers:
-            headers['Authorization'] = f'Bearer {self.access_token}'
+        session = await self.open()
+        retried = False
+        while True:
+            request_headers = dict(headers)
+            if not 'Authorization' in request_headers:
+                access_token = await self.token()
+                request_headers['Authorization'] = f'Bearer {access_token}'
+
+            request = await self.scheduler.request(session, method, url, headers=request_headers, data=data)
+            if request.status == 401 and not retried and not 'Authorization' in headers:
+                # The token was revoked or expired early, get a new one and try again once
+                await self.refresh(access_token)
+                retried = True
+                continue
+            break
 
-        request = await session.get(url, headers=headers)
         if request.status not in self.http_success_codes:
-            logging.error(f'Request to {url} failed')
-            logging.error(f'Error code: {request.status_code}')
-            logging.error(f'Content: {request.content}')
-            exit(1)
+            raise RequestError(url, request.status, await request.text())
 
         return request
 
-    async def apost(self, session, url, data=None, headers=None):
-        if headers is None:
-            headers = {}
+    async def aget(self, url, headers=None):
+        return await self.arequest('GET', url, headers=headers)
 
-        if not 'Authorization' in headers:
-            headers['Authorization'] = f'Bearer {self.access_token}'
+    async def apost(self, url, data=None, headers=None):
+        return await self.arequest('POST', url, data=data, headers=headers)
 
-        request = await session.post(url, headers=headers, data=data)
-        if request.status not in self.http_success_codes:
-            logging.error(f'Request to {url} failed')
-            logging.error(f'Error code: {request.status_code}')
-            logging.error(f'Content: {request.content}')
-            exit(1)
+    async def apages(self, url, page_size, items_key='value', count_key='count', headers=None):
+        """Yield (offset, items) for each page of an offset/limit paginated endpoint, as soon as it arrives.
 
-        return request
+        The first page gives the total count, the remaining pages are then requested concurrently."""
+        separator = '&' if '?' in url else '?'
+
+        async def get_page(offset):
+            request = await self.aget(f'{url}{separator}offset={offset}&limit={page_size}', headers=headers)
+            return offset, await request.json()
+
+        offset, page = await get_page(0)
+        yield offset, page[items_key]
+
+        total = page.get(count_key, len(page[items_key]))
+        # Named after the task paging, eg: the service's task for the profiler
+        name = asyncio.current_task().get_name()
+        tasks = [asyncio.create_task(get_page(offset), name=name) for offset in range(page_size, total, page_size)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                offset, page = await task
+                yield offset, page[items_key]
+        finally:
+            for task in tasks:
+                task.cancel()
 
 class CyberArkPlatformClient(OAuthClient):
-    def __init__(self, subdomain, client_id, client_secret):
+    def __init__(self, subdomain, client_id, client_secret, platform_url=None, **options):
         self.subdomain = subdomain
-        self.identity_url = self.__get_identity_url()
-        super().__init__(f'{self.__get_identity_url()}/oauth2/platformtoken', client_id, client_secret)
+        self.identity_url = None
+        # Serve every platform service from this URL instead of the tenant's, eg: a mock platform, see bench/
+        self.platform_url = platform_url
+        if platform_url is None:
+            self.privilegecloud_url = f'https://{subdomain}.privilegecloud.cyberark.cloud'
+            self.sca_url = f'https://{subdomain}.sca.cyberark.cloud'
+            self.jit_url = f'https://{subdomain}-jit.cyberark.cloud'
+        else:
+            self.privilegecloud_url = self.sca_url = self.jit_url = platform_url
+        options.setdefault('token_cache', TokenCache(subdomain, client_id, client_secret, platform_url=platform_url))
+        super().__init__(None, client_id, client_secret, **options)
+
+    async def login(self):
+        if self.identity_url is None:
+            self.identity_url = await self.__get_identity_url()
+            self.oauth_endpoint = f'{self.identity_url}/oauth2/platformtoken'
+        await super().login()
 
-    def __get_identity_url(self):
-        req = requests.get(f'https://{self.subdomain}.cyberark.cloud/shell/api/endpoint/{self.subdomain}')
+    async def __get_identity_url(self):
+        cached = self.token_cache.load() if self.token_cache is not None else {}
+        if 'identity_url' in cached:
+            return cached['identity_url']
 
-        if req.status_code != 200:
-            logging.error(f'Fail to get Identity URL for subdomain {self.subdomain}')
-            logging.error(f'Error code: {req.status_code}')
-            logging.error(f'Content: {req.content}')
-            exit(1)
+        platform_url = self.platform_url or f'https://{self.subdomain}.cyberark.cloud'
+        url = f'{platform_url}/shell/api/endpoint/{self.subdomain}'
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as req:
+                if req.status != 200:
+                    raise RequestError(url, req.status, await req.text())
+                json = await req.json()
 
-        json = req.json()
-        return f'https://{json["fqdn"]}'
\ No newline at end of file
+        identity_url = f'{urlparse(platform_url).scheme}://{json["fqdn"]}'
+        if self.token_cache is not None:
+            self.token_cache.update(identity_url=identity_url)
+        return identity_url
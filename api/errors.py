@@ -0,0 +1,16 @@
+class RequestError(Exception):
+    def __init__(self, url, status, content):
+        super().__init__(f'Request to {url} failed with status {status}')
+        self.url = url
+        self.status = status
+        self.content = content
+
+
+class QueryError(RequestError):
+    """A request which succeeded but whose query failed, eg: a Redrock query answered with success false"""
+
+    def __init__(self, url, message):
+        Exception.__init__(self, f'Query to {url} failed: {message}')
+        self.url = url
+        self.status = None
+        self.content = message
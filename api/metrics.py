@@ -0,0 +1,174 @@
+import os
+import re
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Paths holding an object id are counted under their template, so every safe adds to the same endpoint
+endpoint_templates = [
+    (re.compile(r'^/PasswordVault/API/Safes/[^/]+/Members$'), '/PasswordVault/API/Safes/{safe}/Members'),
+    (re.compile(r'^/api/policies/[^/]+$'), '/api/policies/{policy}'),
+    (re.compile(r'^/api/access-policies/[^/]+$'), '/api/access-policies/{policy}'),
+    (re.compile(r'^/shell/api/endpoint/[^/]+$'), '/shell/api/endpoint/{tenant}'),
+]
+
+
+def endpoint(url):
+    """Return (host, endpoint template) of url, query string excluded"""
+    parsed = urlparse(url)
+    for pattern, template in endpoint_templates:
+        if pattern.match(parsed.path):
+            return parsed.netloc, template
+    return parsed.netloc, parsed.path
+
+
+class Histogram:
+    # Upper bounds in seconds, the last bucket is +Inf
+    buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the q quantile, None beyond the last bound"""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return self.buckets[index] if index < len(self.buckets) else None
+        return None
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.statuses = {}
+        self.latency = Histogram()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.throttles = 0
+        # Requests which got no response: connection errors and timeouts
+        self.errors = 0
+
+
+class Metrics:
+    """Requests sent by a client, per host, method and endpoint, and time spent in each phase of each service"""
+
+    def __init__(self):
+        self.endpoints = {}
+        self.phases = {}
+        self.started_at = time.time()
+
+    def reset(self):
+        self.endpoints = {}
+        self.phases = {}
+        self.started_at = time.time()
+
+    def request(self, method, url, status, latency, bytes_sent=0, bytes_received=0, retry=False, throttled=False):
+        """Record one attempt, status is None when no response came back"""
+        host, path = endpoint(url)
+        key = (host, method, path)
+        if not key in self.endpoints:
+            self.endpoints[key] = EndpointMetrics()
+        metrics = self.endpoints[key]
+
+        if status is None:
+            metrics.errors += 1
+        else:
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+        metrics.latency.observe(latency)
+        metrics.bytes_sent += bytes_sent
+        metrics.bytes_received += bytes_received
+        if retry:
+            metrics.retries += 1
+        if throttled:
+            metrics.throttles += 1
+
+    @contextmanager
+    def phase(self, service, phase):
+        """Add the time spent in the with block to the service phase, eg: list fetch, detail fetch, join"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = (service, phase)
+            if not key in self.phases:
+                self.phases[key] = [0, 0.0]
+            self.phases[key][0] += 1
+            self.phases[key][1] += time.perf_counter() - started_at
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f'# HELP identity_graph_{name} {help}')
+            lines.append(f'# TYPE identity_graph_{name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{escape(str(label))}"' for key, label in labels.items())
+                lines.append(f'identity_graph_{name}{suffix}{{{label_text}}} {value}')
+
+        endpoints = sorted(self.endpoints.items())
+        labels = {key: {'host': key[0], 'method': key[1], 'endpoint': key[2]} for key, _ in endpoints}
+        metric('requests_total', 'counter', 'HTTP requests sent, retries included, by response status', [
+            ('', dict(labels[key], status=status), count)
+            for key, metrics in endpoints for status, count in sorted(metrics.statuses.items())
+        ])
+        metric('request_errors_total', 'counter', 'HTTP requests which got no response', [
+            ('', labels[key], metrics.errors) for key, metrics in endpoints
+        ])
+        metric('request_retries_total', 'counter', 'HTTP requests sent again after a failure', [
+            ('', labels[key], metrics.retries) for key, metrics in endpoints
+        ])
+        metric('request_throttles_total', 'counter', 'HTTP requests throttled by the host', [
+            ('', labels[key], metrics.throttles) for key, metrics in endpoints
+        ])
+        metric('request_sent_bytes_total', 'counter', 'Bytes of the HTTP request bodies', [
+            ('', labels[key], metrics.bytes_sent) for key, metrics in endpoints
+        ])
+        metric('response_received_bytes_total', 'counter', 'Bytes of the HTTP response bodies', [
+            ('', labels[key], metrics.bytes_received) for key, metrics in endpoints
+        ])
+
+        samples = []
+        for key, metrics in endpoints:
+            histogram = metrics.latency
+            cumulated = 0
+            for index, count in enumerate(histogram.counts):
+                cumulated += count
+                bound = histogram.buckets[index] if index < len(histogram.buckets) else '+Inf'
+                samples.append(('_bucket', dict(labels[key], le=bound), cumulated))
+            samples.append(('_sum', labels[key], histogram.sum))
+            samples.append(('_count', labels[key], histogram.count))
+        metric('request_duration_seconds', 'histogram', 'HTTP request latency', samples)
+
+        phases = sorted(self.phases.items())
+        metric('service_phase_seconds_total', 'counter', 'Time spent by the services in each scan phase', [
+            ('', {'service': service, 'phase': phase}, seconds) for (service, phase), (_, seconds) in phases
+        ])
+        metric('service_phase_runs_total', 'counter', 'Runs of each service scan phase', [
+            ('', {'service': service, 'phase': phase}, count) for (service, phase), (count, _) in phases
+        ])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Write a textfile for the node exporter, renamed into place so it is never read half written"""
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            file.write(self.prometheus())
+        os.replace(temporary_path, path)
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
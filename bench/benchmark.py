@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import socket
+import sys
+import time
+import urllib.request
+
+from aiohttp import web
+
+from api.client import CyberArkPlatformClient
+from bench import mock_platform
+from services.manager import ServiceManager
+
+
+def serve(args, port):
+    # Runs in its own process, the server load must not show in the scan's CPU and memory
+    web.run_app(mock_platform.from_args(args).app(), host='127.0.0.1', port=port, print=None)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def mock_stats(platform_url):
+    with urllib.request.urlopen(f'{platform_url}/_mock/stats') as response:
+        return json.load(response)
+
+
+def start_mock(args):
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(args, port), daemon=True)
+    process.start()
+    platform_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            mock_stats(platform_url)
+            return process, platform_url
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Mock platform did not start')
+
+
+def time_phases(manager, started_at):
+    """Record the fetch and join durations of each service, and when it was done since started_at"""
+    timings = {}
+    for name, service in manager.services.items():
+        timings[name] = {'fetch': 0.0, 'join': 0.0, 'done': None}
+
+        def timed(name, phase, function):
+            def record(phase_started_at):
+                timings[name][phase] += time.perf_counter() - phase_started_at
+                if phase == 'join':
+                    timings[name]['done'] = time.perf_counter() - started_at[0]
+
+            if asyncio.iscoroutinefunction(function):
+                async def timed_function(roles):
+                    phase_started_at = time.perf_counter()
+                    await function(roles)
+                    record(phase_started_at)
+            else:
+                def timed_function(roles):
+                    phase_started_at = time.perf_counter()
+                    function(roles)
+                    record(phase_started_at)
+            return timed_function
+
+        service.fetch = timed(name, 'fetch', service.fetch)
+        service.join = timed(name, 'join', service.join)
+    return timings
+
+
+def benchmark(args, platform_url):
+    client = CyberArkPlatformClient('mock', 'bench', 'bench', platform_url=platform_url, token_cache=None,
+                                    pool_size=args.pool_size, pool_per_host=args.pool_per_host,
+                                    host_rate=args.host_rate, max_retries=args.max_retries)
+    asyncio.run(client.login())
+
+    manager = ServiceManager(client)
+    for name in args.services.split(','):
+        if not manager.enable(name):
+            raise ValueError(f'Unknown service: {name}')
+    for service in manager.services.values():
+        service.quiet = True
+
+    started_at = [0.0]
+    timings = time_phases(manager, started_at)
+    before = mock_stats(platform_url)
+    started_at[0] = time.perf_counter()
+    roles = manager.run(force=True)
+    wall_time = time.perf_counter() - started_at[0]
+    after = mock_stats(platform_url)
+
+    requests = after['requests'] - before['requests']
+    return {
+        'roles': len(roles),
+        'edges': sum(len(service_data.data) for role in roles for service_data in role.services_data),
+        'wall_time': wall_time,
+        'requests': requests,
+        'requests_per_second': requests / wall_time,
+        'throttled': after['throttled'] - before['throttled'],
+        'bytes': after['bytes'] - before['bytes'],
+        # Linux reports kilobytes
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'services': {name: timing for name, timing in timings.items() if timing['done'] is not None},
+    }
+
+
+def report(result):
+    print(f'Scanned {result["roles"]} roles, {result["edges"]} edges')
+    print(f'wall time      {result["wall_time"]:.2f} s')
+    print(f'requests       {result["requests"]} ({result["requests_per_second"]:.1f}/s), '
+          f'{result["throttled"]} throttled, {result["bytes"] / 2 ** 20:.1f} MiB received')
+    print(f'peak RSS       {result["peak_rss_mib"]:.1f} MiB')
+    print(f'{"service":<15}{"fetch":>10}{"join":>10}{"done at":>10}')
+    for name, timing in sorted(result['services'].items(), key=lambda item: item[1]['done']):
+        print(f'{name:<15}{timing["fetch"]:>9.2f}s{timing["join"]:>9.2f}s{timing["done"]:>9.2f}s')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.benchmark',
+        description='Scan a local mock CyberArk platform end to end and report the scan performance',
+        parents=[mock_platform.parser()],
+    )
+    parser.add_argument('--services', default='all', help='comma separated services to scan, or all (default)')
+    parser.add_argument('--pool-size', type=int, default=100)
+    parser.add_argument('--pool-per-host', type=int, default=20)
+    parser.add_argument('--host-rate', type=int, default=None,
+                        help='requests per second never exceeded per host, by default limited only once throttled')
+    parser.add_argument('--max-retries', type=int, default=6)
+    parser.add_argument('--json', help='also write the results to this file, to compare runs')
+    args = parser.parse_args(argv)
+
+    process, platform_url = start_mock(args)
+    try:
+        result = benchmark(args, platform_url)
+    finally:
+        process.terminate()
+
+    report(result)
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(dict(result, arguments=vars(args)), file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
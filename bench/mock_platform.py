@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+
+class MockPlatform:
+    """Local stand-in for a CyberArk tenant, serving generated roles, members, webapps, safes and policies
+    on the endpoints the services call. Every response can be delayed and randomly throttled"""
+
+    def __init__(self, roles=1000, members_per_role=20, users=5000, webapps_per_role=3, webapps=200, safes=2000,
+                 members_per_safe=10, sca_policies=200, sia_policies=200, latency=0.02, jitter=0.01, throttle=0.0,
+                 retry_after=None, bulk=True, fail_after=None, seed=0):
+        self.roles = roles
+        self.members_per_role = members_per_role
+        self.users = users
+        self.webapps_per_role = webapps_per_role
+        self.webapps = webapps
+        self.safes = safes
+        self.members_per_safe = members_per_safe
+        self.sca_policies = sca_policies
+        self.sia_policies = sia_policies
+        # Seconds added to every response, plus or minus a random jitter
+        self.latency = latency
+        self.jitter = jitter
+        # Share of the requests answered with 429, with a Retry-After header when retry_after is set
+        self.throttle = throttle
+        self.retry_after = retry_after
+        # Without bulk, Redrock refuses the RoleMember and RoleApplication queries like some tenants do
+        self.bulk = bulk
+        # Answer 500 to every request once this many were served, to test failed and resumed scans
+        self.fail_after = fail_after
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'throttled': 0, 'bytes': 0}
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/shell/api/endpoint/{tenant}', self.endpoint)
+        app.router.add_post('/oauth2/platformtoken', self.token)
+        app.router.add_post('/Redrock/Query', self.redrock_query)
+        app.router.add_post('/Roles/GetRoleMembers', self.role_members)
+        app.router.add_post('/SaasManage/GetRoleApps', self.role_apps)
+        app.router.add_get('/PasswordVault/API/Safes', self.safes_list)
+        app.router.add_get('/PasswordVault/API/Safes/{safe}/Members', self.safe_members)
+        app.router.add_get('/api/policies', self.sca_policies_list)
+        app.router.add_get('/api/policies/{policy}', self.sca_policy)
+        app.router.add_get('/api/access-policies', self.sia_policies_list)
+        app.router.add_get('/api/access-policies/{policy}', self.sia_policy)
+        app.router.add_get('/_mock/stats', self.get_stats)
+        app.router.add_post('/_mock/config', self.set_config)
+        return app
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path.startswith('/_mock/'):
+            return await handler(request)
+
+        self.stats['requests'] += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.fail_after is not None and self.stats['requests'] > self.fail_after:
+            return web.Response(status=500, text='Failure injected by the mock platform')
+        if self.random.random() < self.throttle:
+            self.stats['throttled'] += 1
+            headers = {} if self.retry_after is None else {'Retry-After': str(self.retry_after)}
+            return web.Response(status=429, headers=headers)
+
+        response = await handler(request)
+        self.stats['bytes'] += len(response.body)
+        return response
+
+    def json(self, data):
+        return web.Response(text=json.dumps(data), content_type='application/json')
+
+    def role_name(self, index):
+        return f'Role {index}'
+
+    def role_member_rows(self, index):
+        rows = [
+            {'Name': f'user{(index * self.members_per_role + j) % self.users}@mock.cloud', 'Type': 'User'}
+            for j in range(self.members_per_role)
+        ]
+        # Every tenth role is nested in the previous one
+        if index % 10 == 1:
+            rows.append({'Name': self.role_name(index - 1), 'Type': 'Role'})
+        return rows
+
+    def role_app_rows(self, index):
+        return [
+            {'ID': f'app{(index + j) % self.webapps}', 'Name': f'App {(index + j) % self.webapps}'}
+            for j in range(self.webapps_per_role)
+        ]
+
+    async def endpoint(self, request):
+        return self.json({'fqdn': request.host})
+
+    async def token(self, request):
+        return self.json({'access_token': 'mock-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    async def redrock_query(self, request):
+        query = await request.json()
+        script = query['Script']
+        if 'RoleMember' in script or 'RoleApplication' in script:
+            if not self.bulk:
+                return self.json({'success': False, 'Message': 'Query not supported by the mock platform'})
+            return self.json(self.bulk_page(script, query.get('Args', {})))
+
+        return self.json({'success': True, 'Result': {'Count': self.roles, 'Results': [
+            {'Row': {'ID': f'role{index}', 'Name': self.role_name(index), 'OrgPath': None}}
+            for index in range(self.roles)
+        ]}})
+
+    def bulk_page(self, script, args):
+        page_size = args.get('PageSize', 10000)
+        first = (args.get('PageNumber', 1) - 1) * page_size
+        rows_per_role = self.role_member_rows if 'RoleMember' in script else self.role_app_rows
+
+        # Rows are generated role by role, only for the roles the page covers
+        rows = []
+        full_count = 0
+        for index in range(self.roles):
+            role_rows = rows_per_role(index)
+            if full_count + len(role_rows) > first and len(rows) < page_size:
+                start = max(0, first - full_count)
+                for row in role_rows[start:start + page_size - len(rows)]:
+                    rows.append({'Row': dict(row, RoleID=f'role{index}')})
+            full_count += len(role_rows)
+        return {'success': True, 'Result': {'Count': len(rows), 'FullCount': full_count, 'Results': rows}}
+
+    async def role_members(self, request):
+        index = int(request.query['name'][len('role'):])
+        rows = self.role_member_rows(index)
+        return self.json({'success': True, 'Result': {'Count': len(rows), 'Results': [{'Row': row} for row in rows]}})
+
+    async def role_apps(self, request):
+        index = int(request.query['role'][len('role'):])
+        rows = self.role_app_rows(index)
+        return self.json({'success': True, 'Result': {'Count': len(rows), 'Results': [{'Row': row} for row in rows]}})
+
+    def page(self, request, items):
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', 25))
+        return self.json({'value': items[offset:offset + limit], 'count': len(items)})
+
+    async def safes_list(self, request):
+        return self.page(request, [
+            {'safeUrlId': f'safe{index}', 'safeName': f'Safe {index}'} for index in range(self.safes)
+        ])
+
+    async def safe_members(self, request):
+        index = int(request.match_info['safe'][len('safe'):])
+        members = [{'memberName': self.role_name(index % self.roles), 'memberType': 'Group'}]
+        members += [
+            {'memberName': f'user{(index * self.members_per_safe + j) % self.users}@mock.cloud', 'memberType': 'User'}
+            for j in range(self.members_per_safe - 1)
+        ]
+        return self.page(request, members)
+
+    async def sca_policies_list(self, request):
+        return self.json({'hits': [
+            {'policyId': f'sca{index}', 'name': f'SCA Policy {index}', 'updatedOn': 1}
+            for index in range(self.sca_policies)
+        ]})
+
+    async def sca_policy(self, request):
+        index = int(request.match_info['policy'][len('sca'):])
+        return self.json({'entities': [
+            {'entityName': self.role_name((index * 3 + j) % self.roles), 'entityClass': 'role'} for j in range(3)
+        ] + [{'entityName': f'user{index % self.users}@mock.cloud', 'entityClass': 'user'}]})
+
+    async def sia_policies_list(self, request):
+        return self.json({'items': [
+            {'policyId': f'sia{index}', 'policyName': f'SIA Policy {index}', 'updatedOn': 1}
+            for index in range(self.sia_policies)
+        ]})
+
+    async def sia_policy(self, request):
+        index = int(request.match_info['policy'][len('sia'):])
+        return self.json({'userAccessRules': [
+            {
+                'ruleName': f'Rule {rule}',
+                'userData': {
+                    'roles': [{'name': self.role_name((index * 2 + rule) % self.roles)}],
+                    'users': [{'name': f'user{(index + rule) % self.users}@mock.cloud'}],
+                },
+            }
+            for rule in range(2)
+        ]})
+
+    async def get_stats(self, request):
+        return self.json(self.stats)
+
+    async def set_config(self, request):
+        """Change the latency, jitter, throttle, retry_after, bulk or fail_after of the running mock"""
+        config = await request.json()
+        for name in ['latency', 'jitter', 'throttle', 'retry_after', 'bulk', 'fail_after']:
+            if name in config:
+                setattr(self, name, config[name])
+        return self.json({'success': True})
+
+
+def parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    size = parser.add_argument_group('mock tenant')
+    size.add_argument('--roles', type=int, default=1000)
+    size.add_argument('--members-per-role', type=int, default=20)
+    size.add_argument('--users', type=int, default=5000)
+    size.add_argument('--webapps-per-role', type=int, default=3)
+    size.add_argument('--webapps', type=int, default=200)
+    size.add_argument('--safes', type=int, default=2000)
+    size.add_argument('--members-per-safe', type=int, default=10)
+    size.add_argument('--sca-policies', type=int, default=200)
+    size.add_argument('--sia-policies', type=int, default=200)
+    size.add_argument('--latency', type=float, default=0.02, help='seconds added to every response')
+    size.add_argument('--jitter', type=float, default=0.01, help='random seconds added to or removed from latency')
+    size.add_argument('--throttle', type=float, default=0.0, help='share of the requests answered with 429')
+    size.add_argument('--retry-after', type=int, default=None, help='Retry-After seconds of the 429 responses')
+    size.add_argument('--no-bulk', dest='bulk', action='store_false', help='refuse the bulk Redrock queries')
+    size.add_argument('--fail-after', type=int, default=None, help='answer 500 once this many requests were served')
+    size.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def from_args(args):
+    return MockPlatform(
+        roles=args.roles, members_per_role=args.members_per_role, users=args.users,
+        webapps_per_role=args.webapps_per_role, webapps=args.webapps, safes=args.safes,
+        members_per_safe=args.members_per_safe,
+        sca_policies=args.sca_policies, sia_policies=args.sia_policies, latency=args.latency, jitter=args.jitter,
+        throttle=args.throttle, retry_after=args.retry_after, bulk=args.bulk, fail_after=args.fail_after,
+        seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description='Mock CyberArk platform', parents=[parser()])
+    arguments.add_argument('--port', type=int, default=8080)
+    args = arguments.parse_args()
+    web.run_app(from_args(args).app(), host='127.0.0.1', port=args.port)
@@ -0,0 +1,102 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Python code run by each scenario, in a fresh interpreter
+scenarios = {
+    # Interactive shell up to its prompt
+    'shell': 'import main; main.Cli()',
+    # Batch scan up to its first request: the HTTP client and every service
+    'batch': 'import main, api.client, dotenv; from services.manager import ServiceManager; '
+             'ServiceManager(None).enable("all")',
+}
+
+
+def import_times(stderr):
+    """Parse the -X importtime report into {module: (self us, cumulative us, depth)}"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_time), int(cumulative), (len(name) - len(name.lstrip())) // 2)
+    return modules
+
+
+def run(code, root):
+    """Run code in a fresh interpreter and return (wall time in seconds, import times)"""
+    started_at = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root, capture_output=True,
+                             text=True)
+    wall_time = time.perf_counter() - started_at
+    if process.returncode != 0:
+        raise RuntimeError(f'{code} failed: {process.stderr.splitlines()[-1]}')
+    return wall_time, import_times(process.stderr)
+
+
+def measure(code, root, repeat, baseline):
+    """Return the median wall and import times of code, imports done by the bare interpreter excluded"""
+    wall_times = []
+    totals = []
+    self_times = {}
+    for _ in range(repeat):
+        wall_time, modules = run(code, root)
+        wall_times.append(wall_time)
+        # Top level imports hold the time of the modules they import in turn
+        totals.append(sum(
+            cumulative for name, (_, cumulative, depth) in modules.items() if depth == 1 and not name in baseline
+        ))
+        for name, (self_time, _, _) in modules.items():
+            if not name in baseline:
+                self_times.setdefault(name, []).append(self_time)
+    return {
+        'wall_ms': statistics.median(wall_times) * 1000,
+        'import_ms': statistics.median(totals) / 1000,
+        'modules': len(self_times),
+        'slowest': sorted(
+            ((name, statistics.median(times) / 1000) for name, times in self_times.items()), key=lambda item: -item[1]
+        ),
+    }
+
+
+def report(results, top):
+    for name, result in results.items():
+        print(f'{name:<8} import {result["import_ms"]:7.1f} ms   wall {result["wall_ms"]:7.1f} ms   '
+              f'{result["modules"]} modules')
+        for module, milliseconds in result['slowest'][:top]:
+            print(f'    {milliseconds:7.2f} ms  {module}')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.startup',
+        description='Measure the imports of the shell and of batch scans with python -X importtime',
+    )
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each scenario, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules shown per scenario')
+    parser.add_argument('--max-ms', type=float, help='exit with 1 when a scenario imports for longer, eg: in CI')
+    parser.add_argument('--json', help='also write the results to this file, to compare runs')
+    args = parser.parse_args(argv)
+
+    root = Path(__file__).resolve().parent.parent
+    _, baseline = run('pass', root)
+    results = {name: measure(code, root, args.repeat, baseline) for name, code in scenarios.items()}
+    report(results, args.top)
+
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(dict(results, arguments=vars(args)), file, indent=2)
+    if args.max_ms is not None:
+        slow = [name for name, result in results.items() if result['import_ms'] > args.max_ms]
+        if len(slow) > 0:
+            print(f'Import time over {args.max_ms:g} ms: {", ".join(slow)}', file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,15 +1,18 @@
-import asyncio
+import argparse
 import cmd
 import logging
 import os
+import sys
 from pathlib import Path
 from time import sleep
 
-from dotenv import load_dotenv
-from tqdm import tqdm
+from api.errors import RequestError
+from objects.index import RoleIndex
+from output import ndjson, text
+from output.stream import RoleStream
 
-from api.client import CyberArkPlatformClient
-from services.manager import ServiceManager
+# The HTTP client (aiohttp), services, stores and dotenv are imported by the commands which use them,
+# so the shell and batch runs start without loading what they do not need, see bench/startup.py
 
 class Cli(cmd.Cmd):
     def __init__(self):
@@ -18,15 +21,40 @@ class Cli(cmd.Cmd):
         self.intro = 'Welcome to Identity Graph'
 
     service_manager = None
+    store = None
     roles = []
+    index = RoleIndex([])
+    graph = None
+    # Snapshot file the roles are read from, see 'import'
+    snapshot = None
+    # Services missing from the roles after a failed scan, see 'scan --resume'
+    missing = []
+    # Scan running in the background, and the index of the roles it listed so far with what they were indexed at
+    background = None
+    scan_index = None
+    scan_index_key = None
+    # HTTP connection pool and rate limiting settings, see 'set'
+    settings = {
+        'pool_size': 100,
+        'pool_per_host': 20,
+        # Requests per second never exceeded per host, None: limited only once the host throttles us
+        'host_rate': None,
+        'max_retries': 6,
+    }
 
     def preloop(self):
         logging.debug('Allocate new Service Manager')
 
+    def precmd(self, line):
+        self.__check_scan()
+        return line
+
     def postloop(self):
         logging.debug('Deallocate Service Manager')
 
     def do_load(self, args):
+        from tqdm import tqdm
+
         text = ""
         for char in tqdm(["a", "b", "c", "d"]):
             sleep(0.25)
@@ -34,6 +62,9 @@ class Cli(cmd.Cmd):
 
     def do_login(self, args):
         """Login to CyberArk Platform"""
+        if self.__scanning():
+            return
+
         arg_list = args.split(' ')
         if arg_list[0] == '':
             print('Missing argument: file, interactive\n')
@@ -53,12 +84,14 @@ class Cli(cmd.Cmd):
     def do_ls(self, args):
         """List roles and associated services"""
         if len(args) < 1:
-            print('Missing argument: roles, services\n')
+            print('Missing argument: roles, services, cycles\n')
             return
         elif args == 'roles':
             self.__list_roles()
         elif args == 'services':
             self.__list_services()
+        elif args == 'cycles' and not self.__scanning():
+            self.__list_cycles()
         return
 
 
@@ -91,24 +124,239 @@ class Cli(cmd.Cmd):
             return
 
         """Show role content"""
-        found = False
-        for role in self.roles:
-            if role.name == args:
-                found = True
-                self.__print_role(role)
+        if self.__lazy():
+            roles = self.__lookup(lambda index: index.get(args))
+            if roles is None:
+                return
+            for role in roles:
+                print(text.format_role(role))
+        else:
+            _, index, missing = self.__current()
+            roles = index.get(args)
+            for role in roles:
+                self.__print_role(role, missing)
 
-        if not found:
+        if len(roles) == 0:
             print(f'Role {args} not found')
 
+    def do_access(self, args):
+        """Show everything a user, group or role effectively reaches, through nested roles included"""
+        if not args:
+            print('Missing argument: <principal name>')
+            return
+
+        if self.__scanning():
+            return
+
+        graph = self.__get_graph()
+        node_ids = graph.find(args)
+        if len(node_ids) == 0:
+            print(f'Principal {args} not found')
+            return
+
+        for node_id in node_ids:
+            self.__print_access(graph, node_id)
+
+    def do_who(self, args):
+        """Show the roles and users who can reach a safe, policy or webapp: who <safe|policy|webapp> <name>"""
+        element_kind, _, name = args.partition(' ')
+        if element_kind not in ['safe', 'policy', 'webapp']:
+            print('Missing argument: safe, policy, webapp')
+            return
+        if name == '':
+            print('Missing argument: <name>')
+            return
+
+        if self.__scanning():
+            return
+
+        if self.snapshot is not None:
+            # Elements of the imported snapshot, the access graph is built from them
+            results = self.snapshot.find(element_kind, name)
+        elif self.service_manager is not None:
+            results = [(service.name, element) for service, element in self.service_manager.find(element_kind, name)]
+        else:
+            print('Not logged in')
+            return
+
+        if len(results) == 0:
+            print(f'No {element_kind} {name} found in the scanned roles')
+            return
+
+        graph = self.__get_graph()
+        for source, element in results:
+            self.__print_reached_by(graph, source, element)
+
     def do_scan(self, args):
-        """Scan for role usage in services. Print results as a tree"""
+        """Scan for role usage in services in the background, only services whose last scan expired are fetched again.
+        Meanwhile 'cat', 'grep' and 'ls roles' show the roles listed so far, flagged with the services still pending.
+        Use 'scan force' to fetch every enabled service.
+        Use 'scan --resume' after a failed scan to skip the safes, policies and roles it already fetched.
+        Use 'scan status' to see what each service is doing, 'scan wait' to wait for the scan, 'scan stop' to cancel it.
+        Use 'scan tenants [--workers <n>] [--output <directory>] <file> [<file> ...]' to scan the tenants of several
+        credentials files in parallel, each tenant's roles are written to <directory>/<tenant>.txt"""
+        from services.background import BackgroundScan
+
+        if args.startswith('tenants'):
+            self.__scan_tenants(args.split()[1:])
+            return
+
+        if args in ['status', 'wait', 'stop']:
+            self.__control_scan(args)
+            return
+
+        if self.service_manager is None:
+            print('Not logged in')
+            return
+
+        if args not in ['', 'force', '--resume']:
+            print(f'Invalid argument: {args}')
+            return
+
+        if self.__scanning():
+            return
+
+        self.background = BackgroundScan(self.service_manager, force=args == 'force', resume=args == '--resume')
+        self.background.start()
+        print('Scanning in the background, see \'scan status\'')
+
+    def do_export(self, args):
+        """Save the scanned roles to a binary snapshot file: export <file>"""
+        from store.snapshot import write_snapshot
+
+        if self.__scanning():
+            return
+
+        if not args:
+            print('Missing argument: <file>')
+            return
+
+        if len(self.roles) == 0:
+            print('No roles found. Please run the \'scan\' command first.')
+            return
+
+        try:
+            write_snapshot(args, self.roles, (
+                grant for service in self.__grant_sources() for grant in service.grants(self.roles)
+            ))
+        except OSError as e:
+            print(f'Export failed: {e}')
+            return
+        print(f'{len(self.roles)} roles exported to {args}')
+
+    def do_import(self, args):
+        """Open a snapshot file saved by 'export', roles are read from the file as commands need them: import <file>"""
+        from store.snapshot import Snapshot
+
+        if self.__scanning():
+            return
+
+        if not args:
+            print('Missing argument: <file>')
+            return
+
+        try:
+            snapshot = Snapshot(args)
+        except (OSError, ValueError) as e:
+            print(f'Import failed: {e}')
+            return
+
+        self.__set_roles(snapshot.roles, snapshot)
+        print(f'{len(self.roles)} roles imported from {args}')
+
+    def do_diff(self, args):
+        """Show the roles whose access changed between two snapshots saved by 'export': diff <old file> [<new file>],
+        the current roles are compared with the old snapshot when no new one is given"""
+        from store.diff import diff_roles
+        from store.snapshot import Snapshot
+
+        arg_list = args.split()
+        if len(arg_list) not in [1, 2]:
+            print('Missing argument: <old file> [<new file>]')
+            return
+
+        if len(arg_list) == 1 and self.__scanning():
+            return
+
+        try:
+            old = Snapshot(arg_list[0])
+            new = Snapshot(arg_list[1]) if len(arg_list) == 2 else None
+        except (OSError, ValueError) as e:
+            print(f'Diff failed: {e}')
+            return
+
+        diffs = diff_roles(old.roles, new.roles if new is not None else self.roles)
+        for diff in diffs:
+            print(text.format_diff(diff))
+        if len(diffs) == 0:
+            print('No role access changed')
+
+        old.close()
+        if new is not None:
+            new.close()
+
+    def do_stats(self, args):
+        """Show the requests sent by the last scan and the time spent in each service phase.
+        Use 'stats prometheus <file>' to write them as a Prometheus textfile, eg: for the node exporter"""
         if self.service_manager is None:
             print('Not logged in')
             return
 
+        metrics = self.service_manager.client.metrics
+        arg_list = args.split()
+        if len(arg_list) > 0 and arg_list[0] == 'prometheus':
+            if len(arg_list) < 2:
+                print('Missing argument: <file>')
+                return
+            try:
+                metrics.write_prometheus(arg_list[1])
+            except OSError as e:
+                print(f'Export failed: {e}')
+                return
+            print(f'Metrics written to {arg_list[1]}')
+            return
+
+        print(text.format_stats(metrics))
+
+    def do_profile(self, args):
+        """Run a scan under the profiler: profile scan [force] [--output <directory>]. A cProfile file and a collapsed
+        stacks file (for flamegraph.pl or speedscope) are written to the directory, default 'profiles'"""
+        from services.profiler import ScanProfiler
+
+        arg_list = args.split()
+        if len(arg_list) == 0 or arg_list[0] != 'scan':
+            print('Missing argument: scan')
+            return
+
+        if self.service_manager is None:
+            print('Not logged in')
+            return
+
+        if self.__scanning():
+            return
+
+        force = False
+        output_dir = 'profiles'
+        arg_list = arg_list[1:]
+        while len(arg_list) > 0:
+            arg = arg_list.pop(0)
+            if arg == 'force':
+                force = True
+            elif arg == '--output' and len(arg_list) > 0:
+                output_dir = arg_list.pop(0)
+            else:
+                print(f'Invalid argument: {arg}')
+                return
+
         print('Please wait...')
-        self.roles = self.service_manager.run()
-        print('Scan complete!')
+        profiler = ScanProfiler(self.service_manager, output_dir)
+        try:
+            self.__set_roles(profiler.run(force))
+        except RequestError as e:
+            logging.error(f'Content: {e.content}')
+            print(f'Scan failed: {e}')
+            return
+        print(profiler.summary())
 
     def do_enable(self, args):
         """Enable a service to be scanned for role usage"""
@@ -120,6 +368,9 @@ class Cli(cmd.Cmd):
             print('Missing argument: <service name>')
             return
 
+        if self.__scanning():
+            return
+
         if self.service_manager.enable(args):
             if args == 'all':
                 print(f'All services enabled')
@@ -128,17 +379,101 @@ class Cli(cmd.Cmd):
         else:
             print(f'Failed to enable {args}')
 
+    def do_set(self, args):
+        """Change a setting: set <pool_size|pool_per_host|host_rate|max_retries> <value>, set ttl <service> <seconds>.
+        set host_rate 0 removes the rate cap"""
+        arg_list = args.split(' ')
+        if arg_list[0] == '':
+            for name, value in self.settings.items():
+                print(f'{name} = {value}')
+            return
+
+        if self.__scanning():
+            return
+
+        if arg_list[0] == 'ttl':
+            self.__set_ttl(arg_list[1:])
+            return
+
+        if arg_list[0] not in self.settings:
+            print(f'Unknown setting: {arg_list[0]}')
+            return
+
+        if len(arg_list) < 2 or not arg_list[1].isdigit() or (
+                int(arg_list[1]) < 1 and arg_list[0] not in ['max_retries', 'host_rate']):
+            print('Missing argument: <positive integer>')
+            return
+
+        self.settings[arg_list[0]] = int(arg_list[1])
+        if arg_list[0] == 'host_rate' and self.settings['host_rate'] == 0:
+            self.settings['host_rate'] = None
+        if self.service_manager is not None:
+            setattr(self.service_manager.client, arg_list[0], self.settings[arg_list[0]])
+        print(f'{arg_list[0]} set to {arg_list[1]}')
+
     def do_exit(self, args):
         """Exit the program"""
+        if self.background is not None:
+            # Stopped rather than killed, so the items it fetched are checkpointed for 'scan --resume'
+            self.background.stop()
+            self.background.join()
         exit()
 
+    def __scan_tenants(self, arg_list):
+        from services.tenants import scan_tenants
+
+        if self.__scanning():
+            return
+
+        workers = os.cpu_count() or 4
+        output_dir = 'scans'
+        env_paths = []
+        while len(arg_list) > 0:
+            arg = arg_list.pop(0)
+            if arg == '--workers' and len(arg_list) > 0 and arg_list[0].isdigit() and int(arg_list[0]) > 0:
+                workers = int(arg_list.pop(0))
+            elif arg == '--output' and len(arg_list) > 0:
+                output_dir = arg_list.pop(0)
+            elif Path(arg).is_file():
+                env_paths.append(arg)
+            else:
+                print(f'Invalid argument or missing file: {arg}')
+                return
+
+        if len(env_paths) == 0:
+            print('Missing argument: <credentials file> [<credentials file> ...]')
+            return
+
+        print(f'Scanning {len(env_paths)} tenants with {min(workers, len(env_paths))} workers...')
+        results = scan_tenants(env_paths, output_dir, workers, self.settings)
+        failed = [result for result in results if result[3] is not None]
+        print(f'Scan complete! {len(results) - len(failed)} tenants scanned, {len(failed)} failed')
+
+    def __set_ttl(self, arg_list):
+        if self.service_manager is None:
+            print('Not logged in')
+            return
+
+        if len(arg_list) < 2 or not arg_list[1].isdigit():
+            print('Missing argument: <service name> <seconds>')
+            return
+
+        if arg_list[0] not in self.service_manager.service_classes:
+            print(f'Unknown service: {arg_list[0]}')
+            return
+
+        self.service_manager.service(arg_list[0]).ttl = int(arg_list[1])
+        print(f'{arg_list[0]} results are reused for {arg_list[1]} seconds')
+
     def __list_services(self):
         """List available CyberArk services"""
         print('Services status')
         print('--------------------------------------------------')
         column_size = 40
-        for service_name in self.service_manager.services:
-            service_status = 'Enabled' if self.service_manager.services[service_name].enabled else 'Disabled'
+        services = self.service_manager.services
+        for service_name in self.service_manager.service_classes:
+            enabled = service_name in services and services[service_name].enabled
+            service_status = 'Enabled' if enabled else 'Disabled'
             service_name_size = len(service_name)
             while service_name_size < column_size:
                 service_name += ' '
@@ -147,55 +482,239 @@ class Cli(cmd.Cmd):
             print(f'{service_name} {service_status}')
 
     def __list_roles(self):
-        if len(self.roles) == 0:
+        roles, _, missing = self.__current()
+        if len(roles) == 0 and self.background is not None:
+            print('No roles listed yet, see \'scan status\'')
+        elif len(roles) == 0:
             print('No roles found. Please run the \'scan\' command first.')
 
-        for role in self.roles:
-            self.__print_role(role)
+        for role in roles:
+            self.__print_role(role, missing)
+
+    def __print_role(self, role, missing):
+        print(text.format_role(role, missing))
+
+    def __current(self):
+        """Return the roles, their index and the services missing from them. During a background scan these are
+        the roles listed so far and the services not done yet"""
+        if self.background is None:
+            return self.roles, self.index, self.missing
+
+        manager = self.service_manager
+        roles = list(manager.roles)
+        missing = [manager.services[name].name for name in list(manager.incomplete) if name != 'Roles']
+        # Joined elements show up on the roles themselves, the index is rebuilt as roles and services come in
+        key = (len(roles), len(missing))
+        if key != self.scan_index_key:
+            self.scan_index = RoleIndex(roles)
+            self.scan_index_key = key
+        return roles, self.scan_index, missing
+
+    def __scanning(self):
+        """Tell commands which change the session or need whole results that a background scan is running"""
+        self.__check_scan()
+        if self.background is None:
+            return False
+        print('A scan is running, see \'scan status\', wait for it with \'scan wait\' or cancel it with \'scan stop\'')
+        return True
+
+    def __control_scan(self, args):
+        if self.background is None:
+            print('No scan running')
+            return
 
-    def __print_role(self, role):
-        print(f'{role}')
-        for svc_data in role.services_data:
-            if len(svc_data.data) == 0:
-                continue
+        if args == 'status':
+            manager = self.service_manager
+            print(text.format_scan_status(self.background.elapsed(), len(manager.roles), manager.status()))
+            return
 
-            print(f'  |-> {svc_data.name}')
-            for elm in svc_data.data:
-                print(f'  |    |-> {elm}')
+        if args == 'stop':
+            self.background.stop()
+        try:
+            self.background.join()
+        except KeyboardInterrupt:
+            print('Still scanning in the background')
+            return
+        self.__check_scan()
 
-    def __grep_data(self, search_pattern):
-        roles_to_print = []
-        for role in self.roles:
-            is_done = False
-            for service_data in role.services_data:
-                if is_done:
-                    break
-                for elm in service_data.data:
-                    if is_done:
-                        break
-                    if search_pattern in elm.name:
-                        is_done = True
-                        roles_to_print.append(role)
+    def __check_scan(self):
+        """Take the results of the background scan once it is over"""
+        if self.background is None or self.background.is_alive():
+            return
+
+        scan = self.background
+        self.background = None
+        self.scan_index = None
+        self.scan_index_key = None
+        if scan.error is not None:
+            if isinstance(scan.error, RequestError):
+                logging.error(f'Content: {scan.error.content}')
+            print(f'Scan failed: {str(scan.error) or "stopped"}')
+            self.__set_partial_roles()
+            return
 
+        self.__set_roles(scan.roles)
+        reused = [
+            name for name, service in self.service_manager.services.items()
+            if service.enabled and name not in self.service_manager.fetched
+        ]
+        if len(reused) > 0:
+            print(f'Reused stored results of: {", ".join(reused)}')
+        print(f'Scan complete in {scan.elapsed():.0f}s!')
+
+    def __set_partial_roles(self):
+        """Keep the roles of a failed scan, flagged with the services which did not complete"""
+        self.__set_roles(self.service_manager.roles)
+        services = self.service_manager.services
+        self.missing = [services[name].name for name in self.service_manager.incomplete if name != 'Roles']
+        if len(self.roles) == 0:
+            print('No partial results, run \'scan --resume\' to continue')
+            return
+        print(f'Partial results: {", ".join(self.missing)} did not complete, every role is flagged. '
+              f'Run \'scan --resume\' to continue')
+
+    def __set_roles(self, roles, snapshot=None):
+        if self.snapshot is not None and self.snapshot is not snapshot:
+            self.snapshot.close()
+        self.snapshot = snapshot
+        self.missing = []
+        self.roles = roles
+        # A snapshot has lookup tables of its own, built from the file on first use
+        self.index = snapshot if snapshot is not None else RoleIndex(roles)
+        self.graph = None
+
+    def __get_graph(self):
+        """Build the access graph of the current scan on first use"""
+        from objects.graph import AccessGraph
+
+        if self.graph is None:
+            self.graph = AccessGraph.build(self.roles, self.__grant_sources())
+        return self.graph
+
+    def __grant_sources(self):
+        """Return what grants(roles) is asked to build the access graph or a snapshot: the imported snapshot, or the
+        enabled services"""
+        if self.snapshot is not None:
+            return [self.snapshot]
+        if self.service_manager is not None:
+            return [service for service in self.service_manager.services.values() if service.enabled]
+        return []
+
+    def __print_access(self, graph, node_id):
+        from services.manager import ServiceManager
+
+        kind, name = graph.nodes[node_id]
+        print(f'{name} ({kind})')
+
+        roles = graph.roles(node_id)
+        if len(roles) > 0:
+            print(f'  |-> Roles')
+            for role, direct_role in roles.items():
+                via = '' if role == direct_role else f' (via {graph.nodes[direct_role][1]})'
+                print(f'  |    |-> {graph.nodes[role][1]}{via}')
+
+        access_by_service = {}
+        for service_data_name, element, role in graph.access(node_id):
+            if not service_data_name in access_by_service:
+                access_by_service[service_data_name] = {}
+            # An element reached through several roles is shown once, with the first role
+            access_by_service[service_data_name].setdefault(id(element), (element, role))
+
+        for service_data_name in sorted(access_by_service, key=ServiceManager.services_data_order.index):
+            print(f'  |-> {service_data_name}')
+            for element, role in access_by_service[service_data_name].values():
+                via = '' if role is None else f' (via {graph.nodes[role][1]})'
+                print(f'  |    |-> {element}{via}')
+
+    def __print_reached_by(self, graph, source, element):
+        print(f'{element} ({source})')
+
+        principals_by_kind = {}
+        for node_id, granted_role in graph.reached_by(element).items():
+            kind, name = graph.nodes[node_id]
+            if not kind in principals_by_kind:
+                principals_by_kind[kind] = []
+            via = '' if granted_role is None else f' (via {graph.nodes[granted_role][1]})'
+            principals_by_kind[kind].append(f'{name}{via}')
+
+        for kind in sorted(principals_by_kind, key=lambda kind: (kind != 'role', kind)):
+            print(f'  |-> {kind.capitalize()}s')
+            for principal in sorted(principals_by_kind[kind]):
+                print(f'  |    |-> {principal}')
+
+    def __list_cycles(self):
+        cycles = self.__get_graph().cycles()
+        if len(cycles) == 0:
+            print('No nested roles cycle found')
+
+        for cycle in cycles:
+            print(' -> '.join(cycle + [cycle[0]]))
+
+    def __grep_data(self, search_pattern):
+        _, index, missing = self.__current()
+        roles_to_print = index.grep_data(search_pattern)
         for role in roles_to_print:
-            self.__print_role(role)
+            self.__print_role(role, missing)
 
         if len(roles_to_print) == 0:
             print('No roles found')
 
     def __grep_role(self, search_pattern):
-        for role in self.roles:
-            if not search_pattern in role.name:
-                continue
-            self.__print_role(role)
+        if self.__lazy():
+            for role in self.__lookup(lambda index: index.grep_roles(search_pattern)) or []:
+                print(text.format_role(role))
+            return
+
+        _, index, missing = self.__current()
+        for role in index.grep_roles(search_pattern):
+            self.__print_role(role, missing)
+
+    def __lazy(self):
+        """Roles are looked up on demand until every enabled service was scanned, unless a scan is running or the
+        last one failed: its partial results are shown flagged with the services they miss instead"""
+        return (self.snapshot is None and self.background is None and self.service_manager is not None
+                and len(self.missing) == 0 and not self.service_manager.complete())
+
+    def __lookup(self, select):
+        """Fetch only what the selected roles need, see ServiceManager.lookup(). Return None on failure"""
+        try:
+            return self.service_manager.lookup(select)
+        except (RequestError, KeyboardInterrupt) as e:
+            if isinstance(e, RequestError):
+                logging.error(f'Content: {e.content}')
+            print(f'Lookup failed: {str(e) or "interrupted"}')
+            return None
 
     def __login(self, tenant_id, client_id, client_secret):
-        client = CyberArkPlatformClient(tenant_id, client_id, client_secret)
-        self.service_manager = ServiceManager(client)
+        import asyncio
+
+        from api.client import CyberArkPlatformClient
+        from services.manager import ServiceManager
+        from store.scan_store import ScanStore
+
+        client = CyberArkPlatformClient(tenant_id, client_id, client_secret, **self.settings)
+        try:
+            asyncio.run(client.login())
+        except RequestError as e:
+            logging.error(f'Content: {e.content}')
+            print(f'Login failed: {e}')
+            return
+        except OSError as e:
+            print(f'Login failed: {e}')
+            return
+        if self.store is None:
+            self.store = ScanStore()
+        self.service_manager = ServiceManager(client, self.store)
         self.prompt = f'[{tenant_id}] # '
         print(f'Successfully logged in to {tenant_id}')
 
+        self.__set_roles(self.service_manager.load())
+        if len(self.roles) > 0:
+            print(f'Loaded {len(self.roles)} roles from the last scan')
+
     def __login_from_env(self, env_path_str):
+        from dotenv import load_dotenv
+
         env_path = Path(env_path_str)
         if not env_path.exists() or not env_path.is_file():
             print('Missing credentials or environment file')
@@ -214,6 +733,99 @@ class Cli(cmd.Cmd):
         client_secret = input('Client secret: ')
         self.__login(tenant_id, client_id, client_secret)
 
+def batch(argv):
+    """Run a single command without the interactive shell,
+    eg: main.py scan --env .env --services all --format ndjson"""
+    parser = argparse.ArgumentParser(prog='main.py', description='Identity Graph, run without arguments for the shell')
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan = commands.add_parser('scan', help='scan a tenant and stream its roles to stdout')
+    scan.add_argument('--env', default='.env', help='credentials file with TENANT_ID, CLIENT_ID and CLIENT_SECRET')
+    scan.add_argument('--services', default='all', help='comma separated services to scan, or all (default)')
+    scan.add_argument('--format', choices=['ndjson', 'text'], default='ndjson', help='one JSON record or one text '
+                      'tree per role (default ndjson)')
+    scan.add_argument('--quiet', action='store_true', help='hide the progress bars')
+    scan.add_argument('--metrics-file', help='write the scan metrics to this Prometheus textfile')
+    scan.add_argument('--resume', action='store_true', help='skip what the last, failed scan already fetched')
+    args = parser.parse_args(argv)
+
+    if args.command == 'scan':
+        return batch_scan(args)
+    return 2
+
+
+def batch_scan(args):
+    import asyncio
+    from dotenv import dotenv_values
+
+    from api.client import CyberArkPlatformClient
+    from services.manager import ServiceManager
+    from store.scan_store import ScanStore
+
+    if not Path(args.env).is_file():
+        print(f'Missing credentials or environment file: {args.env}', file=sys.stderr)
+        return 2
+
+    credentials = dotenv_values(args.env)
+    client = CyberArkPlatformClient(credentials.get('TENANT_ID'), credentials.get('CLIENT_ID'),
+                                    credentials.get('CLIENT_SECRET'), **Cli.settings)
+    try:
+        asyncio.run(client.login())
+    except (RequestError, OSError) as e:
+        print(f'Login failed: {e}', file=sys.stderr)
+        return 1
+
+    service_manager = ServiceManager(client, ScanStore())
+    for name in args.services.split(','):
+        if not service_manager.enable(name.strip()):
+            print(f'Unknown service: {name}', file=sys.stderr)
+            return 2
+    for service in service_manager.services.values():
+        service.quiet = args.quiet
+
+    # Roles are streamed through a large buffer of our own instead of one print() per line
+    stream = open(sys.stdout.fileno(), 'w', encoding='utf-8', buffering=1 << 16, closefd=False)
+    roles = RoleStream(stream, ndjson.format_role if args.format == 'ndjson' else text.format_role)
+    written = set()
+
+    def write_role(role):
+        written.add(role.id)
+        roles.write(role)
+
+    try:
+        # Roles complete in bursts as services are joined, hand each burst over right away
+        service_manager.run(on_done=lambda name: roles.flush(), on_role=write_role, resume=args.resume)
+    except (RequestError, KeyboardInterrupt) as e:
+        if isinstance(e, RequestError):
+            logging.error(f'Content: {e.content}')
+        print(f'Scan failed: {str(e) or "interrupted"}, the roles not written yet follow flagged as partial',
+              file=sys.stderr)
+        services = service_manager.services
+        missing = [services[name].name for name in service_manager.incomplete if name != 'Roles']
+        for role in service_manager.roles:
+            if not role.id in written:
+                roles.write(role, missing)
+        return 1
+    except BrokenPipeError:
+        # The consumer stopped reading, eg: piped to head
+        return 0
+    finally:
+        try:
+            roles.close()
+        except BrokenPipeError:
+            pass
+
+    logging.info(f'{roles.count} roles written')
+    if args.metrics_file is not None:
+        try:
+            client.metrics.write_prometheus(args.metrics_file)
+        except OSError as e:
+            print(f'Failed to write metrics: {e}', file=sys.stderr)
+            return 1
+    return 0
+
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.WARNING)
+    if len(sys.argv) > 1:
+        sys.exit(batch(sys.argv[1:]))
     Cli().cmdloop()
\ No newline at end of file
@@ -0,0 +1,186 @@
+class AccessGraph:
+    """Adjacency graph of a scan: principals (users, groups, roles) are members of roles, and are granted
+    safes, policies and webapps, directly or through the roles they are transitively members of"""
+
+    # Service data name of the grants which make a principal member of a role
+    membership = 'Roles'
+    # Principal types of the services which name Identity roles
+    role_types = ['role', 'group']
+
+    def __init__(self):
+        self.nodes = []
+        self.node_ids = {}
+        self.node_ids_by_name = {}
+        self.member_of = []
+        self.members = []
+        self.grants = []
+        self.grantees = {}
+        self.components = None
+        self.closures = {}
+
+    @classmethod
+    def build(cls, roles, services):
+        graph = cls()
+        for role in roles:
+            graph.node('Role', role.name)
+        for service in services:
+            for principal_type, principal_name, service_data_name, element in service.grants(roles):
+                graph.grant(principal_type, principal_name, service_data_name, element)
+        graph.components = graph.__strongly_connected_components()
+        return graph
+
+    def kind(self, principal_type):
+        # Privilege Cloud names roles 'Group', SCA 'role' and SIA 'Role', they all point to Identity roles
+        principal_type = principal_type.lower()
+        return 'role' if principal_type in self.role_types else principal_type
+
+    def node(self, principal_type, principal_name):
+        key = (self.kind(principal_type), principal_name)
+        node_id = self.node_ids.get(key)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.node_ids[key] = node_id
+            if not principal_name in self.node_ids_by_name:
+                self.node_ids_by_name[principal_name] = []
+            self.node_ids_by_name[principal_name].append(node_id)
+            self.nodes.append(key)
+            self.member_of.append([])
+            self.members.append([])
+            self.grants.append([])
+        return node_id
+
+    def grant(self, principal_type, principal_name, service_data_name, element):
+        node_id = self.node(principal_type, principal_name)
+        if service_data_name == self.membership:
+            role_id = self.node('Role', element.name)
+            self.member_of[node_id].append(role_id)
+            self.members[role_id].append(node_id)
+        else:
+            self.grants[node_id].append((service_data_name, element))
+            if not id(element) in self.grantees:
+                self.grantees[id(element)] = []
+            self.grantees[id(element)].append(node_id)
+
+    def find(self, name):
+        return self.node_ids_by_name.get(name, [])
+
+    def roles(self, node_id):
+        """Return {role node: direct role it is reached through} for every role node_id is transitively member of"""
+        via = {}
+        for direct_role in self.member_of[node_id]:
+            via.setdefault(direct_role, direct_role)
+            for role in self.closure(direct_role):
+                via.setdefault(role, direct_role)
+        via.pop(node_id, None)
+        return via
+
+    def closure(self, node_id):
+        """Return the role nodes node_id is transitively member of, memoized per strongly connected component"""
+        component = self.components[node_id]
+        if component in self.closures:
+            return self.closures[component]
+
+        # Iterative post-order over the components graph, each closure is built from its successors' closures
+        stack = [(component, False)]
+        while len(stack) > 0:
+            current, expanded = stack.pop()
+            if current in self.closures:
+                continue
+            successors = self.component_successors[current]
+            if not expanded:
+                stack.append((current, True))
+                stack.extend((successor, False) for successor in successors if successor not in self.closures)
+                continue
+
+            closure = set()
+            for member in self.component_members[current]:
+                closure.update(self.member_of[member])
+            for successor in successors:
+                closure |= self.closures[successor]
+            self.closures[current] = frozenset(closure)
+        return self.closures[component]
+
+    def access(self, node_id):
+        """Return (service data name, element, role it is granted through or None) of everything node_id reaches"""
+        results = [(service_data_name, element, None) for service_data_name, element in self.grants[node_id]]
+        for role, direct_role in self.roles(node_id).items():
+            for service_data_name, element in self.grants[role]:
+                results.append((service_data_name, element, role))
+        return results
+
+    def reached_by(self, element):
+        """Return {principal node: role granted the element it is reached through, None when granted directly}
+        of every principal reaching element, in time proportional to the result"""
+        via = {}
+        queue = []
+        for node_id in self.grantees.get(id(element), []):
+            if not node_id in via:
+                via[node_id] = None
+                queue.append((node_id, node_id))
+
+        while len(queue) > 0:
+            role, granted_role = queue.pop()
+            for member in self.members[role]:
+                if not member in via:
+                    via[member] = granted_role
+                    queue.append((member, granted_role))
+        return via
+
+    def cycles(self):
+        """Return the groups of roles which are transitively members of each other"""
+        cycles = []
+        for members in self.component_members:
+            if len(members) > 1 or members[0] in self.member_of[members[0]]:
+                cycles.append([self.nodes[member][1] for member in members])
+        return cycles
+
+    def __strongly_connected_components(self):
+        """Tarjan's algorithm, iterative to support deep role nesting"""
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        components = [None] * len(self.nodes)
+        self.component_members = []
+
+        for root in range(len(self.nodes)):
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while len(work) > 0:
+                node_id, edge = work.pop()
+                if edge == 0:
+                    index[node_id] = lowlink[node_id] = len(index)
+                    stack.append(node_id)
+                    on_stack.add(node_id)
+
+                successors = self.member_of[node_id]
+                if edge < len(successors):
+                    work.append((node_id, edge + 1))
+                    successor = successors[edge]
+                    if not successor in index:
+                        work.append((successor, 0))
+                    elif successor in on_stack:
+                        lowlink[node_id] = min(lowlink[node_id], index[successor])
+                    continue
+
+                if lowlink[node_id] == index[node_id]:
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        components[member] = len(self.component_members)
+                        members.append(member)
+                        if member == node_id:
+                            break
+                    self.component_members.append(members)
+
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node_id])
+
+        self.component_successors = [
+            set(components[successor] for member in members for successor in self.member_of[member]) - {component}
+            for component, members in enumerate(self.component_members)
+        ]
+        return components
@@ -1,4 +1,11 @@
+import sys
+
+
 class CyberarkObject:
+    __slots__ = ('id', 'name')
+    # Objects shared between many roles, safes and policies (members, webapps) exist once per scan, see get()
+    identity_map = {}
+
     def __init__(self, id, name):
         self.id = id
         self.name = name
@@ -6,53 +13,95 @@ class CyberarkObject:
     def __str__(self):
         return f'{self.name}'
 
+    @classmethod
+    def get(cls, *args):
+        """Return the instance built with these arguments, creating it on first use"""
+        key = (cls, *args)
+        instance = CyberarkObject.identity_map.get(key)
+        if instance is None:
+            instance = cls(*args)
+            CyberarkObject.identity_map[key] = instance
+        return instance
+
+    @staticmethod
+    def clear_identity_map():
+        CyberarkObject.identity_map.clear()
+
 class Role(CyberarkObject):
+    __slots__ = ('orgpath', 'services_data')
+
     def __init__(self, role_data):
-        super().__init__(role_data['Row']['ID'], role_data['Row']['Name'])
+        # Role names are interned to share them with the members naming the role
+        super().__init__(role_data['Row']['ID'], sys.intern(role_data['Row']['Name']))
         self.orgpath = role_data['Row']['OrgPath']
         self.services_data = []
 
 class Member(CyberarkObject):
+    __slots__ = ('type',)
+
     def __init__(self, name, type):
         super().__init__(f'{type}/{name}', name)
         self.type = type
 
+    @classmethod
+    def get(cls, name, type):
+        return super().get(sys.intern(name), sys.intern(type))
+
 class SafeMember(Member):
-    def __init__(self, member_data):
-        super().__init__(member_data['memberName'], member_data['memberType'])
+    __slots__ = ()
+
+    @classmethod
+    def from_data(cls, member_data):
+        return cls.get(member_data['memberName'], member_data['memberType'])
 
 class SIAPolicyRuleMember(Member):
-    def __init__(self, name, type):
-        super().__init__(name, type)
+    __slots__ = ()
 
 class RoleMember(Member):
-    def __init__(self, member_data):
-        super().__init__(member_data['Name'], 'Group')
+    __slots__ = ()
+
+    @classmethod
+    def from_data(cls, member_data):
+        # Members are users, groups or nested roles
+        return cls.get(member_data['Name'], member_data.get('Type', 'Group'))
 
 class Safe(CyberarkObject):
+    __slots__ = ('members',)
+
     def __init__(self, safe_data):
         super().__init__(safe_data['safeUrlId'], safe_data['safeName'])
         self.members = []
 
 class SCAPolicy(CyberarkObject):
+    __slots__ = ('members', 'fingerprint')
+
     def __init__(self, policy_data):
         super().__init__(policy_data['policyId'], policy_data['name'])
         self.members = []
+        self.fingerprint = None
 
 class SCAPolicyMember(Member):
-    def __init__(self, policy_member_data):
+    __slots__ = ()
+
+    @classmethod
+    def from_data(cls, policy_member_data):
         if 'entityClass' in policy_member_data:
-            super().__init__(policy_member_data['entityName'], policy_member_data['entityClass'])
+            return cls.get(policy_member_data['entityName'], policy_member_data['entityClass'])
         else:
-            super().__init__(policy_member_data['entityName'], 'user')
+            return cls.get(policy_member_data['entityName'], 'user')
 
 
 class SIAPolicy(CyberarkObject):
+    __slots__ = ('rules', 'fingerprint')
+
     def __init__(self, policy_data):
         super().__init__(policy_data['policyId'], policy_data['policyName'])
         self.rules = []
+        self.fingerprint = None
 
 class SIAPolicyRule(CyberarkObject):
+    __slots__ = ('members', 'policy_name')
+
     def __init__(self, policy_rule_data, policy_name):
         super().__init__(policy_rule_data['ruleName'], policy_rule_data['ruleName'])
         self.members = []
@@ -62,5 +111,8 @@ class SIAPolicyRule(CyberarkObject):
         return f'{self.policy_name} (rule: {self.name})'
 
 class Webapp(CyberarkObject):
-    def __init__(self, webapp_data):
-        super().__init__(webapp_data['ID'], webapp_data['Name'])
\ No newline at end of file
+    __slots__ = ()
+
+    @classmethod
+    def from_data(cls, webapp_data):
+        return cls.get(webapp_data['ID'], sys.intern(webapp_data['Name']))
@@ -0,0 +1,113 @@
+class NgramIndex:
+    """Substring search over a set of strings, each string pointing to the positions of the roles it belongs to"""
+
+    def __init__(self, n=3):
+        self.n = n
+        self.strings = []
+        self.string_ids = {}
+        self.positions = []
+        self.ngrams = {}
+
+    def add(self, string, position):
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.string_ids[string] = string_id
+            self.strings.append(string)
+            self.positions.append(set())
+            for i in range(len(string) - self.n + 1):
+                ngram = string[i:i + self.n]
+                if not ngram in self.ngrams:
+                    self.ngrams[ngram] = set()
+                self.ngrams[ngram].add(string_id)
+        self.positions[string_id].add(position)
+
+    def search(self, pattern):
+        """Return the positions of the roles owning a string which contains pattern"""
+        if len(pattern) < self.n:
+            candidates = range(len(self.strings))
+        else:
+            postings = []
+            for i in range(len(pattern) - self.n + 1):
+                ngram = pattern[i:i + self.n]
+                if not ngram in self.ngrams:
+                    return set()
+                postings.append(self.ngrams[ngram])
+            postings.sort(key=len)
+            candidates = set.intersection(*postings)
+
+        positions = set()
+        for string_id in candidates:
+            # Ngrams may match out of order, confirm the substring
+            if pattern in self.strings[string_id]:
+                positions |= self.positions[string_id]
+        return positions
+
+
+class RoleIndex:
+    """Lookup tables over the scanned roles, built once per scan"""
+
+    def __init__(self, roles):
+        self.roles = roles
+        self.by_name = {}
+        self.by_id = {}
+        self.role_names = NgramIndex()
+        self.data_names = NgramIndex()
+
+        for position, role in enumerate(roles):
+            if not role.name in self.by_name:
+                self.by_name[role.name] = []
+            self.by_name[role.name].append(role)
+            self.by_id[role.id] = role
+            self.role_names.add(role.name, position)
+            for service_data in role.services_data:
+                for elm in service_data.data:
+                    self.data_names.add(elm.name, position)
+
+    def get(self, name_or_id):
+        """Return the roles with this name, or the role with this ID"""
+        if name_or_id in self.by_name:
+            return self.by_name[name_or_id]
+        if name_or_id in self.by_id:
+            return [self.by_id[name_or_id]]
+        return []
+
+    def grep_roles(self, pattern):
+        return [self.roles[position] for position in sorted(self.role_names.search(pattern))]
+
+    def grep_data(self, pattern):
+        return [self.roles[position] for position in sorted(self.data_names.search(pattern))]
+
+
+class JoinIndex:
+    """Edges between role names and the elements a service joins onto them, kept to look them up both ways"""
+
+    def __init__(self):
+        self.elements_by_role = {}
+        self.elements_by_name = {}
+        self.roles_by_element = {}
+
+    def add(self, role_name, element, name=None):
+        """Join element onto the role, element can be found by name, its own name by default"""
+        if name is None:
+            name = element.name
+
+        if not role_name in self.elements_by_role:
+            self.elements_by_role[role_name] = []
+        self.elements_by_role[role_name].append(element)
+
+        if not id(element) in self.roles_by_element:
+            self.roles_by_element[id(element)] = []
+            if not name in self.elements_by_name:
+                self.elements_by_name[name] = []
+            self.elements_by_name[name].append(element)
+        self.roles_by_element[id(element)].append(role_name)
+
+    def elements(self, role_name):
+        return self.elements_by_role.get(role_name, [])
+
+    def find(self, name):
+        return self.elements_by_name.get(name, [])
+
+    def roles(self, element):
+        return self.roles_by_element.get(id(element), [])
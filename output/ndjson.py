@@ -0,0 +1,34 @@
+import json
+
+# Element attributes added to the records when the element has them
+element_attributes = ['type', 'policy_name']
+
+
+def format_role(role, missing=None):
+    """Return the role and its services data as a single line JSON record, flagged as partial when missing lists
+    the services which did not complete the scan"""
+    return json.dumps(role_record(role, missing), ensure_ascii=False, separators=(',', ':'))
+
+
+def role_record(role, missing=None):
+    record = {
+        'id': role.id,
+        'name': role.name,
+        'orgpath': role.orgpath,
+        'services': {
+            svc_data.name: [element_record(elm) for elm in svc_data.data]
+            for svc_data in role.services_data if len(svc_data.data) > 0
+        },
+    }
+    if missing:
+        record['partial'] = True
+        record['missing'] = missing
+    return record
+
+
+def element_record(element):
+    record = {'id': element.id, 'name': element.name}
+    for attribute in element_attributes:
+        if hasattr(element, attribute):
+            record[attribute] = getattr(element, attribute)
+    return record
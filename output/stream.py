@@ -0,0 +1,29 @@
+import time
+
+
+class RoleStream:
+    """Write formatted roles to a buffered stream, one per line. The buffer is flushed at most every
+    flush_interval seconds, so a consumer reading a pipe gets roles while the scan is still running
+    without paying for a write system call per role"""
+
+    def __init__(self, stream, format_role, flush_interval=1.0):
+        self.stream = stream
+        self.format_role = format_role
+        self.flush_interval = flush_interval
+        self.count = 0
+        self.flushed_at = time.monotonic()
+
+    def write(self, role, missing=None):
+        self.stream.write(self.format_role(role, missing))
+        self.stream.write('\n')
+        self.count += 1
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.stream.flush()
+        self.flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.stream.close()
@@ -0,0 +1,70 @@
+def format_role(role, missing=None):
+    """Return the role and its services data as a text tree, flagged as partial when missing lists the services
+    which did not complete the scan"""
+    lines = [f'{role}' if not missing else f'{role} [partial: {", ".join(missing)} missing]']
+    for svc_data in role.services_data:
+        if len(svc_data.data) == 0:
+            continue
+
+        lines.append(f'  |-> {svc_data.name}')
+        for elm in svc_data.data:
+            lines.append(f'  |    |-> {elm}')
+    return '\n'.join(lines)
+
+
+def write_roles(roles, file):
+    for role in roles:
+        file.write(format_role(role))
+        file.write('\n')
+
+
+def format_diff(diff):
+    """Return the elements added to and removed from a role as a text tree, see store.diff"""
+    marks = {'added': '+', 'removed': '-', 'changed': '~'}
+    lines = [f'{marks[diff.status]} {diff.role}']
+    for name in list(diff.added) + [name for name in diff.removed if name not in diff.added]:
+        lines.append(f'  |-> {name}')
+        for elm in diff.added.get(name, []):
+            lines.append(f'  |    + {elm}')
+        for elm in diff.removed.get(name, []):
+            lines.append(f'  |    - {elm}')
+    return '\n'.join(lines)
+
+
+def format_stats(metrics):
+    """Return the requests and service phases recorded by metrics as text tables, see api.metrics"""
+    lines = ['Requests', '-' * 120]
+    lines.append(f'{"endpoint":<62}{"count":>7}{"errors":>7}{"retries":>8}{"throttled":>10}'
+                 f'{"p50":>8}{"p95":>8}{"received":>10}')
+    for (host, method, path), endpoint in sorted(metrics.endpoints.items()):
+        latency = endpoint.latency
+        p50, p95 = latency.quantile(0.5), latency.quantile(0.95)
+        lines.append(
+            f'{method + " " + host + path:<62.62}{latency.count:>7}{endpoint.errors:>7}{endpoint.retries:>8}'
+            f'{endpoint.throttles:>10}{format_seconds(p50):>8}{format_seconds(p95):>8}'
+            f'{endpoint.bytes_received / 2 ** 20:>9.1f}M'
+        )
+
+    lines += ['', 'Service phases', '-' * 120]
+    lines.append(f'{"service":<32}{"phase":<16}{"runs":>6}{"seconds":>10}')
+    for (service, phase), (count, seconds) in sorted(metrics.phases.items()):
+        lines.append(f'{service:<32}{phase:<16}{count:>6}{seconds:>10.2f}')
+    return '\n'.join(lines)
+
+
+def format_scan_status(elapsed, role_count, statuses):
+    """Return the state of each service of a running scan, see ServiceManager.status()"""
+    lines = [f'Scan running for {elapsed:.0f}s, {role_count} roles so far', '-' * 60]
+    for name, state, progress in statuses:
+        if progress is not None:
+            units = progress.unit[:-1] + 'ies' if progress.unit.endswith('y') else progress.unit + 's'
+            state = f'{state} {progress.done}/{progress.total} {units}'
+        lines.append(f'{name:<20}{state}')
+    return '\n'.join(lines)
+
+
+def format_seconds(bound):
+    # Latencies are known up to their histogram bucket
+    if bound is None:
+        return '>10s'
+    return f'<{bound * 1000:g}ms' if bound < 1 else f'<{bound:g}s'
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+import time
+
+
+class BackgroundScan(threading.Thread):
+    """Run a scan on an event loop of its own thread, so the shell stays usable meanwhile. The roles joined so far
+    are in service_manager.roles, the services which are not done yet in service_manager.incomplete"""
+
+    def __init__(self, service_manager, force=False, resume=False):
+        super().__init__(name='background-scan', daemon=True)
+        self.service_manager = service_manager
+        self.force = force
+        self.resume = resume
+        self.started_at = time.time()
+        self.finished_at = None
+        self.loop = None
+        self.task = None
+        self.roles = None
+        self.error = None
+        # Resolved before the thread starts, 'scan status' right after 'scan' must not report the previous run
+        service_manager.prepare(force, resume=resume)
+
+    def run(self):
+        # Progress bars would garble the prompt, 'scan status' reports the progress instead
+        quiet = {name: service.quiet for name, service in self.service_manager.services.items()}
+        for service in self.service_manager.services.values():
+            service.quiet = True
+        try:
+            self.roles = asyncio.run(self.__scan())
+        except (Exception, asyncio.CancelledError) as e:
+            self.error = e
+        finally:
+            for name, service in self.service_manager.services.items():
+                service.quiet = quiet[name]
+            self.finished_at = time.time()
+
+    async def __scan(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        return await self.service_manager.arun(self.force, resume=self.resume, prepared=True)
+
+    def stop(self):
+        """Cancel the scan, the services it saved and the items it checkpointed are kept for 'scan --resume'"""
+        if self.task is None or not self.is_alive():
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        except RuntimeError:
+            # The loop closed meanwhile, the scan is over
+            pass
+
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
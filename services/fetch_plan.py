@@ -0,0 +1,174 @@
+import logging
+from abc import ABCMeta, abstractmethod
+
+from objects.index import JoinIndex
+from services.service import Progress, Service, ServiceData, cancel_tasks, create_task, fingerprint, gather_tasks
+
+
+class FetchPlanService(Service, metaclass=ABCMeta):
+    """Service following a declarative fetch plan: list the items (safes, policies) from one endpoint, fetch each
+    new or changed item in detail from another, then join the elements the items grant onto the roles by name.
+
+    Subclasses declare the endpoints with the class attributes below and read the responses with item(),
+    read_detail(), edges(), dump_item() and load_item(), a subclass missing one of them cannot be created. Paging,
+    concurrency, reuse of unchanged items, checkpoints and the join are done here once for every service"""
+    # Name of the ServiceData joined onto roles, and unit of the progress bar
+    data_name = None
+    unit = 'item'
+    # Client attribute holding the base URL of the endpoints
+    base_url = None
+    # List endpoint, key of its items and page size, None when a single response holds every item
+    list_path = None
+    list_key = 'value'
+    list_page_size = None
+    # Detail endpoint formatted with the item id, paged like the list when detail_page_size is set
+    detail_path = None
+    detail_key = 'value'
+    detail_page_size = None
+    # Items whose list entry did not change keep their details from the previous scan, see fingerprint()
+    incremental = True
+    # Principal types of the edges which name Identity roles
+    role_types = []
+
+    def __init__(self, name, client):
+        super().__init__(name, client)
+        self.items = []
+
+    @abstractmethod
+    def item(self, item_data):
+        """Return the item of a list entry"""
+
+    @abstractmethod
+    def read_detail(self, item, detail):
+        """Fill the item from its detail response, the items of every page when the detail endpoint is paged"""
+
+    @abstractmethod
+    def edges(self, item):
+        """Yield (principal type, principal name, element, element name) for every element the item grants,
+        element name is None when the element is looked up by its own name"""
+
+    @abstractmethod
+    def dump_item(self, item):
+        """Return the item as JSON serializable objects, for dump() and the checkpoints"""
+
+    @abstractmethod
+    def load_item(self, item_data):
+        """Restore the item from the output of dump_item()"""
+
+    async def fetch(self, roles):
+        # Imported on first use like in Service.gather()
+        from tqdm import tqdm
+
+        previous_items = {item.id: item for item in self.items} if self.incremental else {}
+        pages = {}
+        tasks = []
+        self.progress = Progress(self.unit)
+        with tqdm(desc=f'Loading {self.name}', unit=self.unit, colour='#ffffff', disable=self.quiet) as progress:
+            # Items are fetched in detail as soon as the list page naming them arrives,
+            # the detail fetch phase only counts the time left once every page arrived
+            try:
+                with self.phase('list fetch'):
+                    async for offset, page in self.__list_pages():
+                        pages[offset] = []
+                        for item_data in page:
+                            item, changed = self.__plan_item(item_data, previous_items)
+                            pages[offset].append(item)
+                            if changed:
+                                tasks.append(create_task(self.__load_detail(item, progress)))
+                        progress.total = len(tasks)
+                        progress.refresh()
+                        self.progress.total = len(tasks)
+            except BaseException:
+                await cancel_tasks(tasks)
+                raise
+            with self.phase('detail fetch'):
+                await gather_tasks(tasks)
+        self.progress = None
+
+        self.items = [item for offset in sorted(pages) for item in pages[offset]]
+        deleted_count = len(set(previous_items) - set(item.id for item in self.items))
+        logging.info(f'{self.name}: {len(tasks)} new or changed, {len(self.items) - len(tasks)} unchanged, '
+                     f'{deleted_count} deleted')
+
+    def clear(self):
+        self.items = []
+
+    def join(self, roles):
+        # Hash join: the role edges of every item are hashed by role name in one pass, each role then probes it once
+        self.index = JoinIndex()
+        for item in self.items:
+            for principal_type, principal_name, element, element_name in self.edges(item):
+                if principal_type in self.role_types:
+                    self.index.add(principal_name, element, element_name)
+
+        for role in roles:
+            elements = self.index.elements(role.name)
+            if len(elements) == 0:
+                continue
+            role.services_data.append(ServiceData(self.data_name, elements))
+
+    def grants(self, roles):
+        for item in self.items:
+            for principal_type, principal_name, element, _ in self.edges(item):
+                yield principal_type, principal_name, self.data_name, element
+
+    def dump(self):
+        return [self.dump_item(item) for item in self.items]
+
+    def load(self, data):
+        self.items = [self.load_item(item_data) for item_data in data]
+
+    def __plan_item(self, item_data, previous_items):
+        """Return (item, changed), changed items must be fetched in detail"""
+        item = self.item(item_data)
+        if self.incremental:
+            item.fingerprint = fingerprint(item_data)
+            previous_item = previous_items.get(item.id)
+            if previous_item is not None and previous_item.fingerprint == item.fingerprint:
+                return previous_item, False
+
+        checkpointed = self.checkpoint.get(item.id)
+        if checkpointed is not None:
+            # Fetched in detail by an unfinished scan, see 'scan --resume'
+            checkpointed_item = self.load_item(checkpointed)
+            if not self.incremental or checkpointed_item.fingerprint == item.fingerprint:
+                return checkpointed_item, False
+        return item, True
+
+    def __url(self, path):
+        return f'{getattr(self.client, self.base_url)}{path}'
+
+    async def __list_pages(self):
+        headers = {'Content-Type': 'application/json'}
+        if self.list_page_size is None:
+            request = await self.client.aget(self.__url(self.list_path), headers=headers)
+            yield 0, (await request.json())[self.list_key]
+            return
+
+        async for offset, page in self.client.apages(
+            self.__url(self.list_path),
+            self.list_page_size,
+            items_key=self.list_key,
+            headers=headers
+        ):
+            yield offset, page
+
+    async def __load_detail(self, item, progress):
+        headers = {'Content-Type': 'application/json'}
+        url = self.__url(self.detail_path.format(id=item.id))
+        if self.detail_page_size is None:
+            request = await self.client.aget(url, headers=headers)
+            logging.debug(f'Requesting {self.name} {item.id} --> GET {request.url}')
+            detail = await request.json()
+        else:
+            pages = {}
+            async for offset, page in self.client.apages(url, self.detail_page_size, items_key=self.detail_key,
+                                                         headers=headers):
+                logging.debug(f'Requesting {self.name} {item.id} (offset {offset})')
+                pages[offset] = page
+            detail = [elm for offset in sorted(pages) for elm in pages[offset]]
+
+        self.read_detail(item, detail)
+        self.checkpoint.save(item.id, self.dump_item(item))
+        self.progress.done += 1
+        progress.update()
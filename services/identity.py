@@ -1,111 +1,237 @@
-import asyncio
 import json
 import logging
+from abc import ABCMeta, abstractmethod
 
-import aiohttp
-from tqdm.asyncio import tqdm_asyncio
-
+from api.errors import QueryError, RequestError
 from objects.identity import Role, RoleMember, Webapp
-from services.service import Service, ServiceData
+from objects.index import JoinIndex
+from services.service import Service, ServiceData, create_task, gather_tasks
 
 
-class IdentityRoleService(Service):
-    def __init__(self, client):
-        super().__init__('Identity Roles', client)
+async def query_redrock(client, script, page_size):
+    """Run a Redrock SQL query page by page and return all of its results"""
+    url = f'{client.identity_url}/Redrock/Query'
+    headers = {'Content-Type': 'application/json'}
 
-    async def run(self, roles):
-        if not self.enabled:
-            logging.warning("Identity Role Service is disabled")
-            return roles
-
-        async with aiohttp.ClientSession() as session:
-            headers = {'Content-Type': 'application/json'}
-            data = {"Script": 'Select ID, COALESCE(Name, ID) AS Name, OrgPath from Role ORDER BY Name COLLATE NOCASE'}
-            request = await self.client.apost(
-                session,
-                f'{self.client.identity_url}/Redrock/Query',
-                data=json.dumps(data),
-                headers=headers
-            )
-            roles_data = await request.json()
-            for elm in roles_data['Result']['Results']:
-                role = Role(elm)
-                roles.append(role)
+    async def query_page(page_number):
+        data = {'Script': script, 'Args': {'PageNumber': page_number, 'PageSize': page_size, 'Caching': -1}}
+        request = await client.apost(url, data=json.dumps(data), headers=headers)
+        query = await request.json()
+        if not query.get('success', True):
+            raise QueryError(url, query.get('Message'))
+        return query['Result']
+
+    first_page = await query_page(1)
+    results = first_page['Results']
+    if 'FullCount' in first_page:
+        page_count = -(-first_page['FullCount'] // page_size)
+        tasks = [create_task(query_page(number)) for number in range(2, page_count + 1)]
+        for page in await gather_tasks(tasks):
+            results.extend(page['Results'])
+        return results
+
+    # Without a total count, read pages until a short one
+    page = first_page
+    page_number = 1
+    while len(page['Results']) == page_size:
+        page_number += 1
+        page = await query_page(page_number)
+        results.extend(page['Results'])
+    return results
 
-            return roles
 
+class IdentityRoleService(Service):
+    join_requires = []
 
-class IdentityMembersService(Service):
     def __init__(self, client):
-        super().__init__('Identity Members', client)
+        super().__init__('Identity Roles', client)
+        self.roles = []
 
-    async def run(self, roles):
-        if not self.enabled:
-            logging.warning("Identity Members Service is disabled")
-            return roles
+    async def fetch(self, roles):
+        headers = {'Content-Type': 'application/json'}
+        data = {"Script": 'Select ID, COALESCE(Name, ID) AS Name, OrgPath from Role ORDER BY Name COLLATE NOCASE'}
+        request = await self.client.apost(
+            f'{self.client.identity_url}/Redrock/Query',
+            data=json.dumps(data),
+            headers=headers
+        )
+        roles_data = await request.json()
+        self.roles = [Role(elm) for elm in roles_data['Result']['Results']]
+
+    def join(self, roles):
+        # Other services join onto these roles, drop what a previous scan attached
+        for role in self.roles:
+            role.services_data = []
+        roles.extend(self.roles)
+
+    def dump(self):
+        return [{'ID': role.id, 'Name': role.name, 'OrgPath': role.orgpath} for role in self.roles]
+
+    def load(self, data):
+        self.roles = [Role({'Row': row}) for row in data]
+
+
+class RoleElementService(Service, metaclass=ABCMeta):
+    """Service listing the elements (members, web apps) of each Identity role: every role -> element edge at once
+    with a paged Redrock query, or one request per role when the query fails or for a few roles, see lookup().
+
+    Subclasses declare the query and the endpoint with the class attributes below and read the rows with element(),
+    row() and grant(). Checkpoints, the join and the role by role output are done here for every subclass"""
+    fetch_requires = ['Roles']
+    # Name of the ServiceData joined onto roles
+    data_name = None
+    # Get every role -> element edge with a few paged Redrock queries instead of one request per role
+    bulk = True
+    bulk_page_size = 10000
+    # Redrock query of every edge, with the role id in a RoleID column
+    bulk_script = None
+    # Endpoint of the elements of one role, formatted with the role id
+    role_path = None
+
+    def __init__(self, name, client):
+        super().__init__(name, client)
+        self.elements_by_role = {}
+        # Roles already joined by fetch(), when loading one role at a time
+        self.joined_roles = set()
+
+    @abstractmethod
+    def element(self, row):
+        """Return the element of a query or endpoint row"""
+
+    @abstractmethod
+    def row(self, element):
+        """Return the element as a row element() reads, for dump() and the checkpoints"""
+
+    @abstractmethod
+    def grant(self, role, element):
+        """Return (principal type, principal name, service data name, element) of an edge, see Service.grants()"""
+
+    async def fetch(self, roles):
+        self.elements_by_role = {}
+        self.index = JoinIndex()
+        self.joined_roles = set()
+        remaining_roles = [role for role in roles if self.checkpoint.get(role.id) is None]
+        if self.bulk and len(remaining_roles) > 0:
+            try:
+                with self.phase('bulk fetch'):
+                    await self.__load_bulk()
+                return
+            except (RequestError, KeyError) as e:
+                logging.warning(f'Bulk {self.name} query failed, falling back to one request per role: {e}')
+                self.elements_by_role = {}
+
+        # Roles done by an unfinished scan are restored from its checkpoint, see 'scan --resume'
+        for role in roles:
+            rows = self.checkpoint.get(role.id)
+            if rows is not None:
+                self.elements_by_role[role.id] = [self.element(row) for row in rows]
+
+        with self.phase('detail fetch'):
+            await self.gather(
+                [self.__load_role(role) for role in remaining_roles],
+                desc=f'Loading {self.name}',
+                unit='role'
+            )
 
-        await asyncio.gather(self.__load_roles_members(roles))
+    def join(self, roles):
+        if len(self.joined_roles) == 0:
+            self.index = JoinIndex()
+        for role in roles:
+            if not role.id in self.joined_roles:
+                self.__join_role(role)
+        self.joined_roles = set()
+
+    def grants(self, roles):
+        for role in roles:
+            for element in self.elements_by_role.get(role.id, []):
+                yield self.grant(role, element)
+
+    def dump(self):
+        return {role_id: self.__rows(elements) for role_id, elements in self.elements_by_role.items()}
+
+    def __rows(self, elements):
+        return [self.row(element) for element in elements]
+
+    def load(self, data):
+        self.elements_by_role = {
+            role_id: [self.element(row) for row in rows]
+            for role_id, rows in data.items()
+        }
+
+    async def __load_bulk(self):
+        for elm in await query_redrock(self.client, self.bulk_script, self.bulk_page_size):
+            row = elm['Row']
+            if not row['RoleID'] in self.elements_by_role:
+                self.elements_by_role[row['RoleID']] = []
+            self.elements_by_role[row['RoleID']].append(self.element(row))
+
+    async def lookup(self, roles):
+        # One request per role not looked up yet, rather than the bulk query of every role
+        await self.gather(
+            [self.__fetch_role(role) for role in roles if not role.id in self.elements_by_role],
+            desc=f'Loading {self.name}',
+            unit='role'
+        )
+        return False
 
-    async def __load_roles_members(self, roles):
-        async with aiohttp.ClientSession() as session:
-            await tqdm_asyncio.gather(
-                *[self.__load_role_members(role, session) for role in roles],
-                desc="Loading Identity roles members",
-                unit='role',
-                colour='#ffffff'
-            )
+    async def __load_role(self, role):
+        await self.__fetch_role(role)
+        self.checkpoint.save(role.id, self.__rows(self.elements_by_role[role.id]))
+        self.__join_role(role)
+        self.role_joined(role)
 
-    async def __load_role_members(self, role, session):
+    async def __fetch_role(self, role):
         headers = {'Content-Type': 'application/json'}
         request = await self.client.apost(
-            session,
-            f'{self.client.identity_url}/Roles/GetRoleMembers?name='+ role.id,
+            f'{self.client.identity_url}{self.role_path.format(role.id)}',
             headers=headers,
         )
-        logging.debug(f'Requesting role members {role.name} --> GET {request.url}')
-        role_members_data = await request.json()
+        logging.debug(f'Requesting {self.name} of role {role.name} --> POST {request.url}')
+        query = await request.json()
+        self.elements_by_role[role.id] = [self.element(elm['Row']) for elm in query['Result']['Results']]
+
+    def __join_role(self, role):
+        self.joined_roles.add(role.id)
+        if role.id in self.elements_by_role:
+            for element in self.elements_by_role[role.id]:
+                self.index.add(role.name, element)
+            role.services_data.append(ServiceData(self.data_name, self.elements_by_role[role.id]))
 
-        role_members = []
-        for elm in role_members_data['Result']['Results']:
-            role_members.append(RoleMember(elm['Row']))
-        role.services_data.append(ServiceData('Members', role_members))
 
+class IdentityMembersService(RoleElementService):
+    data_name = 'Members'
+    bulk_script = 'Select RoleID, Name, Type from RoleMember ORDER BY RoleID'
+    role_path = '/Roles/GetRoleMembers?name={}'
 
-class IdentityWebAppsService(Service):
     def __init__(self, client):
-        super().__init__('Identity WebApps', client)
+        super().__init__('Identity Members', client)
 
-    async def run(self, roles):
-        if not self.enabled:
-            logging.warning("Identity WebApp Service is disabled")
-            return roles
-        return await asyncio.create_task(self.__load_roles_webapps(roles))
-
-    async def __load_roles_webapps(self, roles):
-        async with aiohttp.ClientSession() as session:
-            roles = await tqdm_asyncio.gather(
-                *[self.__load_role_webapps(role, session) for role in roles],
-                desc="Loading Identity roles webapps",
-                unit='role',
-                colour='#ffffff'
-            )
+    def element(self, row):
+        return RoleMember.from_data(row)
 
-            return roles
+    def row(self, member):
+        return {'Name': member.name, 'Type': member.type}
 
-    async def __load_role_webapps(self, role, session):
-        headers = {'Content-Type': 'application/json'}
-        request = await self.client.apost(
-            session,
-            f'{self.client.identity_url}/SaasManage/GetRoleApps?role='+ role.id,
-            headers=headers,
-        )
+    def grant(self, role, member):
+        return member.type, member.name, 'Roles', role
 
-        logging.debug(f'Requesting Identity Webapp members {role.id} --> GET {request.url}')
 
-        role_webapps = []
-        query = await request.json()
-        for elm in query['Result']['Results']:
-            role_webapps.append(Webapp(elm['Row']))
-        role.services_data.append(ServiceData('Web Apps', role_webapps))
+class IdentityWebAppsService(RoleElementService):
+    element_kind = 'webapp'
+    # Applications assigned to roles rarely change
+    ttl = 6 * 3600
+    data_name = 'Web Apps'
+    bulk_script = 'Select RoleID, ApplicationID AS ID, Name from RoleApplication ORDER BY RoleID'
+    role_path = '/SaasManage/GetRoleApps?role={}'
+
+    def __init__(self, client):
+        super().__init__('Identity WebApps', client)
+
+    def element(self, row):
+        return Webapp.from_data(row)
+
+    def row(self, webapp):
+        return {'ID': webapp.id, 'Name': webapp.name}
 
-        return role
\ No newline at end of file
+    def grant(self, role, webapp):
+        return 'Role', role.name, 'Web Apps', webapp
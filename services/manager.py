@@ -1,30 +1,61 @@
 import asyncio
+import importlib
+import time
 
-from services.identity import IdentityRoleService, IdentityMembersService, IdentityWebAppsService
-from services.privilege_cloud import PrivCloudSafeService
-from services.secure_cloud_access import SCAPoliciesService
-from services.secure_infra_access import SIAPoliciesService
+from objects.identity import CyberarkObject
+from objects.index import RoleIndex
+from services.scheduler import Scheduler
+from services.service import gather_tasks
+from store.scan_store import Checkpoint
 
 class ServiceManager:
-    services = {}
-    def __init__(self, client):
-        self.services['Roles'] = IdentityRoleService(client)
-        self.services['Roles'].enable()
+    # Display order of the ServiceData attached to each role
+    services_data_order = ['Members', 'Web Apps', 'Safes', 'SIA Policies', 'SCA Policies']
+    # Name -> (module, class) of every service, a service module is only imported once the service is used
+    service_classes = {
+        'Roles': ('services.identity', 'IdentityRoleService'),
+        'Members': ('services.identity', 'IdentityMembersService'),
+        'WebApps': ('services.identity', 'IdentityWebAppsService'),
+        'PrivilegeCloud': ('services.privilege_cloud', 'PrivCloudSafeService'),
+        'SIA': ('services.secure_infra_access', 'SIAPoliciesService'),
+        'SCA': ('services.secure_cloud_access', 'SCAPoliciesService'),
+    }
 
-        self.services['Members'] = IdentityMembersService(client)
-        self.services['WebApps'] = IdentityWebAppsService(client)
-        self.services['PrivilegeCloud'] = PrivCloudSafeService(client)
-        self.services['SIA'] = SIAPoliciesService(client)
-        self.services['SCA'] = SCAPoliciesService(client)
+    def __init__(self, client, store=None):
+        self.client = client
+        # Services used so far, in the order of service_classes
+        self.services = {}
+        self.store = store
+        # Timestamp of the data held by each service
+        self.scanned_at = {}
+        # Services fetched by the last run, the others reused their data
+        self.fetched = []
+        # Roles of the last run, and the services which did not complete it when it failed: their data is missing
+        self.roles = []
+        self.incomplete = []
+        # Items finished by the fetched services, kept until each service is saved, see 'scan --resume'
+        self.checkpoints = {}
+        # Every role of the Roles service, to pick the roles of a lookup
+        self.role_index = None
+        self.service('Roles').enable()
+
+    def service(self, name):
+        """Return the service, importing its module and creating it on first use"""
+        if not name in self.services:
+            module, class_name = self.service_classes[name]
+            service = getattr(importlib.import_module(module), class_name)(self.client)
+            services = dict(self.services, **{name: service})
+            self.services = {key: services[key] for key in self.service_classes if key in services}
+        return self.services[name]
 
     def enable(self, name):
         if name == 'all':
-            for service in self.services.values():
-                service.enable()
+            for service_name in self.service_classes:
+                self.service(service_name).enable()
             return True
 
-        if name in self.services:
-            self.services[name].enable()
+        if name in self.service_classes:
+            self.service(name).enable()
             return True
         return False
 
@@ -34,13 +65,194 @@ class ServiceManager:
             return True
         return False
 
-    def run(self):
-        roles = []
-        asyncio.run(self.services['Roles'].run(roles))
-        for name in self.services:
-            if name == 'Roles':
+    def find(self, element_kind, name):
+        """Return (service, element) of the joined elements of this kind with this name"""
+        return [
+            (service, element)
+            for service in self.services.values() if service.enabled and service.element_kind == element_kind
+            for element in service.index.find(name)
+        ]
+
+    def load(self):
+        """Restore the last stored snapshot of the tenant, enable its services and return the joined roles"""
+        if self.store is None:
+            return []
+
+        stored = self.store.scanned_at(self.client.subdomain)
+        for name in self.service_classes:
+            if not name in stored:
+                continue
+            scanned_at, data = self.store.load(self.client.subdomain, name)
+            service = self.service(name)
+            service.load(data)
+            service.enable()
+            self.scanned_at[name] = scanned_at
+
+        if not 'Roles' in self.scanned_at:
+            return []
+        return asyncio.run(self.arun(offline=True))
+
+    def complete(self):
+        """Return True when every enabled service holds the results of a whole scan"""
+        return all(name in self.scanned_at for name, service in self.services.items() if service.enabled)
+
+    def lookup(self, select):
+        return asyncio.run(self.alookup(select))
+
+    async def alookup(self, select):
+        """Return the roles select(RoleIndex of every role) picks, joined with the enabled services, without a scan.
+        Services whose results are missing only fetch what these roles need: the Identity services fetch these
+        roles one by one, the others fetch everything once and are saved as a scan would save them.
+        Everything fetched is kept, so later lookups only fetch the roles they did not see yet"""
+        async with self.client:
+            if not 'Roles' in self.scanned_at:
+                await self.services['Roles'].fetch([])
+                self.__save('Roles')
+                self.role_index = None
+            if self.role_index is None:
+                self.role_index = RoleIndex(self.services['Roles'].roles)
+            roles = select(self.role_index)
+            if len(roles) == 0:
+                return roles
+
+            names = [
+                name for name, service in self.services.items()
+                if service.enabled and name != 'Roles' and not name in self.scanned_at
+            ]
+            tasks = [
+                asyncio.create_task(self.services[name].lookup(roles), name=self.services[name].name) for name in names
+            ]
+            for name, fetched_all in zip(names, await gather_tasks(tasks)):
+                if fetched_all:
+                    self.__save(name)
+
+        # The join indexes of the per role services now only hold these roles until the next scan
+        for role in roles:
+            role.services_data = []
+        for name, service in self.services.items():
+            if service.enabled and name != 'Roles':
+                service.join(roles)
+        for role in roles:
+            self.__sort_services_data(role)
+        return roles
+
+    def status(self):
+        """Return (name, state, progress) of each enabled service during a run. The state is done, reused, waiting
+        or the phase the service is in, progress is its Progress while it loads items in detail, None otherwise"""
+        statuses = []
+        for name, service in self.services.items():
+            if not service.enabled:
                 continue
-            if self.services[name].enabled:
-                asyncio.run(self.services[name].run(roles))
+            if not name in self.incomplete:
+                statuses.append((name, 'done' if name in self.fetched else 'reused', None))
+            elif len(service.phases) > 0:
+                statuses.append((name, service.phases[-1], service.progress))
+            else:
+                statuses.append((name, 'waiting', None))
+        return statuses
+
+    def expired(self, name):
+        if not name in self.scanned_at:
+            return True
+        return time.time() - self.scanned_at[name] >= self.services[name].ttl
+
+    def run(self, force=False, on_done=None, on_role=None, resume=False):
+        return asyncio.run(self.arun(force, on_done=on_done, on_role=on_role, resume=resume))
+
+    def prepare(self, force=False, offline=False, resume=False):
+        """Resolve the services the next run fetches and reset the run state: self.fetched, self.incomplete and
+        self.roles. arun() does it unless told the run is prepared, a background scan does it before its thread
+        starts so 'scan status' never reports the previous run"""
+        enabled = [name for name, service in self.services.items() if service.enabled]
+        resolved = Scheduler(self.services).resolve(enabled)
+        self.fetched = []
+        if resume:
+            # Services a failed run did not complete, in this session or a previous one as their checkpoint
+            # tells, and those whose results expired or no run ever completed
+            checkpointed = self.store.checkpointed(self.client.subdomain) if self.store is not None else []
+            self.fetched = [
+                name for name in resolved if name in self.incomplete or name in checkpointed or self.expired(name)
+            ]
+        elif not offline:
+            self.fetched = [name for name in resolved if force or self.expired(name)]
+        for name in self.fetched:
+            if force:
+                self.services[name].clear()
+            # Services reset their data as they fetch, until it is saved again a failed run must not leave it
+            # looking fresh to the next scan. The stored snapshot is kept until then
+            self.scanned_at.pop(name, None)
+        if len(self.fetched) > 0:
+            # Start a new identity map, data reused from the previous scan keeps its own instances
+            CyberarkObject.clear_identity_map()
+            # Metrics describe the last scan which sent requests
+            self.client.metrics.reset()
+
+        for name in self.fetched:
+            if not resume or not name in self.checkpoints:
+                self.checkpoints[name] = Checkpoint(self.store, self.client.subdomain, name, resume)
+            self.services[name].checkpoint = self.checkpoints[name]
+
+        self.roles = []
+        self.incomplete = resolved
+        self.role_index = None
+
+    async def arun(self, force=False, offline=False, on_done=None, on_role=None, resume=False, prepared=False):
+        """Fetch the enabled services whose data expired (all of them with force, none when offline),
+        reuse the data of the others and return the joined roles.
+        on_role(role) is called with each role as soon as every service joined it, while the scan goes on.
+        Each service is saved as soon as it is done. When the run fails, self.roles holds the roles joined with
+        the services which completed, self.incomplete the others. With resume, the services a failed run did not
+        complete are fetched again whatever their TTL, skipping the items the failed run already fetched.
+        With prepared, the run uses the state prepare() set instead"""
+        if not prepared:
+            self.prepare(force, offline, resume)
+        roles = self.roles
+        enabled = [name for name, service in self.services.items() if service.enabled]
+        scheduler = Scheduler(self.services)
+
+        def service_done(name):
+            self.incomplete.remove(name)
+            if name in self.fetched:
+                self.__save(name)
+            if on_done is not None:
+                on_done(name)
+
+        # Services only append their own ServiceData to each role, without awaiting in between,
+        # so they can safely share the roles list within a single event loop
+        role_done = None
+        if on_role is not None:
+            role_done = lambda role: on_role(self.__sort_services_data(role))
+        try:
+            if len(self.fetched) > 0:
+                async with self.client:
+                    await scheduler.run(enabled, roles, self.fetched, service_done, role_done)
+            else:
+                await scheduler.run(enabled, roles, self.fetched, service_done, role_done)
+        finally:
+            for checkpoint in self.checkpoints.values():
+                checkpoint.flush()
+            # Completion order is not deterministic, restore a stable display order
+            for role in roles:
+                self.__sort_services_data(role)
+
+        return roles
+
+    def __save(self, name):
+        self.scanned_at[name] = time.time()
+        if self.store is not None:
+            self.store.save(self.client.subdomain, name, self.services[name].dump(), self.scanned_at[name])
+        # The saved results replace the checkpoint, services fetched by a lookup have none
+        checkpoint = self.checkpoints.pop(name, None)
+        if checkpoint is not None:
+            checkpoint.clear()
+        self.services[name].checkpoint = Checkpoint()
+
+    def __sort_services_data(self, role):
+        # Assigned rather than sorted in place, the shell may be reading the role during a background scan
+        role.services_data = sorted(role.services_data, key=self.__services_data_rank)
+        return role
 
-        return roles
\ No newline at end of file
+    def __services_data_rank(self, service_data):
+        if service_data.name in self.services_data_order:
+            return self.services_data_order.index(service_data.name)
+        return len(self.services_data_order)
@@ -1,74 +1,42 @@
-import asyncio
-import logging
-
-import aiohttp
-from tqdm.asyncio import tqdm_asyncio
-
 from objects.identity import Safe, SafeMember
-from services.service import Service, ServiceData
+from services.fetch_plan import FetchPlanService
+
+
+class PrivCloudSafeService(FetchPlanService):
+    element_kind = 'safe'
+    data_name = 'Safes'
+    unit = 'safe'
+    base_url = 'privilegecloud_url'
+    list_path = '/PasswordVault/API/Safes'
+    list_page_size = 1000
+    detail_path = '/PasswordVault/API/Safes/{id}/Members'
+    detail_page_size = 1000
+    # Members change without the safe list entry changing, every safe is fetched in detail again
+    incremental = False
+    # Identity roles are safe members of type Group
+    role_types = ['Group']
 
-
-class PrivCloudSafeService(Service):
     def __init__(self, client):
         super().__init__('Privilege Cloud Safes', client)
 
-    async def run(self, roles):
-        if not self.enabled:
-            logging.warning("Privilege Cloud Service is disabled")
-            return roles
-
-        safes = await self.get_safes()
-        await asyncio.create_task(self.__load_safes_members(safes))
-
-        safes_by_role = {}
-        for safe in safes:
-            for member in safe.members:
-                if member.type == 'Group':
-                    if not member.name in safes_by_role:
-                        safes_by_role[member.name] = []
-                    safes_by_role[member.name].append(safe)
-
-        for role in roles:
-            if not role.name in safes_by_role:
-                continue
-            role.services_data.append(ServiceData('Safes', safes_by_role[role.name]))
-
-    async def get_safes(self):
-        async with aiohttp.ClientSession() as session:
-            headers = {'Content-Type': 'application/json'}
-            get_safes_req = await self.client.aget(
-                session,
-                f'https://{self.client.subdomain}.privilegecloud.cyberark.cloud/PasswordVault/API/Safes?limit=100000000',
-                headers=headers
-            )
-
-            query = await get_safes_req.json()
-            safes_data = query['value']
-            safes = []
-            for safe_data in safes_data:
-                safe = Safe(safe_data)
-                safes.append(safe)
+    def item(self, item_data):
+        return Safe(item_data)
 
-            return safes
+    def read_detail(self, safe, members_data):
+        safe.members = [SafeMember.from_data(elm) for elm in members_data]
 
-    async def __load_safes_members(self, safes):
-        async with aiohttp.ClientSession() as session:
-            await tqdm_asyncio.gather(
-                *[self.__load_safe_members(safe, session) for safe in safes],
-                desc="Loading Privilege Cloud safes members",
-                unit='safe',
-                colour='#ffffff'
-            )
+    def edges(self, safe):
+        for member in safe.members:
+            yield member.type, member.name, safe, None
 
-    async def __load_safe_members(self, safe, session):
-        headers = {'Content-Type': 'application/json'}
-        load_safes_members_req = await self.client.aget(
-            session,
-            f'https://{self.client.subdomain}.privilegecloud.cyberark.cloud/PasswordVault/API/Safes/{safe.id}/Members',
-            headers=headers
-        )
+    def dump_item(self, safe):
+        return {
+            'safeUrlId': safe.id,
+            'safeName': safe.name,
+            'members': [{'memberName': member.name, 'memberType': member.type} for member in safe.members],
+        }
 
-        logging.debug(f'Requesting safe members {safe.id} --> GET {load_safes_members_req.url}')
-        safe_members_data = await load_safes_members_req.json()
-        for elm in safe_members_data['value']:
-            safe.members.append(SafeMember(elm))
\ No newline at end of file
+    def load_item(self, safe_data):
+        safe = Safe(safe_data)
+        safe.members = [SafeMember.from_data(elm) for elm in safe_data['members']]
+        return safe
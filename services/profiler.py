@@ -0,0 +1,175 @@
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from pathlib import Path
+
+
+class StackSampler(threading.Thread):
+    """Sample the stack of a thread at a fixed interval. Coroutines waiting on the network are not on the stack,
+    so the samples show where the event loop spends its CPU, and how long it idles waiting for responses"""
+
+    def __init__(self, thread_id, service_names, interval=0.005):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        # Samples are attributed to the service whose task runs, the scheduler names each task after its service
+        # and the tasks a service creates inherit the name, see services.service.create_task()
+        self.service_names = service_names
+        # Event loop of the sampled thread, set once it runs
+        self.loop = None
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.count = 0
+        self.stacks = {}
+        self.categories = {}
+        self.leaves = {}
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            task = asyncio.current_task(self.loop) if self.loop is not None else None
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.record(frame, task.get_name() if task is not None else None)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def record(self, frame, task_name=None):
+        names = []
+        service = task_name if task_name in self.service_names else None
+        category = None
+        leaf = None
+        while frame is not None:
+            code = frame.f_code
+            # co_qualname holds the class of methods, on Python 3.11 and later only
+            qualname = getattr(code, 'co_qualname', code.co_name)
+            name = f'{os.path.basename(code.co_filename)}:{qualname}'
+            names.append(name)
+            if leaf is None:
+                leaf = name
+            if category is None:
+                category = self.category(code)
+            frame = frame.f_back
+
+        if category is None:
+            category = 'python'
+        if service is None:
+            service = 'event loop'
+        self.count += 1
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        if not service in self.categories:
+            self.categories[service] = {}
+            self.leaves[service] = {}
+        self.categories[service][category] = self.categories[service].get(category, 0) + 1
+        self.leaves[service][leaf] = self.leaves[service].get(leaf, 0) + 1
+
+    @staticmethod
+    def category(code):
+        path = code.co_filename.replace('\\', '/')
+        if path.endswith('/selectors.py'):
+            return 'network wait'
+        if '/json/' in path:
+            return 'json decoding'
+        if path.endswith('/objects/identity.py'):
+            return 'object construction'
+        return None
+
+    def write_collapsed(self, path):
+        """Write the samples as collapsed stacks, the input of flamegraph.pl or speedscope"""
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f'{stack} {count}\n')
+
+
+class ScanProfiler:
+    """Run a scan under cProfile and a stack sampler, while measuring the event loop lag"""
+
+    def __init__(self, service_manager, output_dir='profiles', interval=0.005, lag_interval=0.05):
+        self.service_manager = service_manager
+        self.output_dir = Path(output_dir)
+        self.interval = interval
+        self.lag_interval = lag_interval
+        self.lags = []
+        self.sampler = None
+        self.stats = None
+        self.wall_time = 0.0
+        self.pstats_path = None
+        self.collapsed_path = None
+
+    def run(self, force=False):
+        """Scan, write the profiles to output_dir and return the joined roles"""
+        service_names = set(service.name for service in self.service_manager.services.values())
+        self.sampler = StackSampler(threading.get_ident(), service_names, self.interval)
+        profile = cProfile.Profile()
+
+        started_at = time.perf_counter()
+        self.sampler.start()
+        profile.enable()
+        try:
+            roles = asyncio.run(self.__run(force))
+        finally:
+            profile.disable()
+            self.sampler.stop()
+            self.wall_time = time.perf_counter() - started_at
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        name = time.strftime('scan-%Y%m%d-%H%M%S')
+        self.pstats_path = self.output_dir / f'{name}.pstats'
+        self.collapsed_path = self.output_dir / f'{name}.collapsed'
+        profile.dump_stats(self.pstats_path)
+        self.sampler.write_collapsed(self.collapsed_path)
+        self.stats = pstats.Stats(profile)
+        return roles
+
+    async def __run(self, force):
+        self.sampler.loop = asyncio.get_running_loop()
+        monitor = asyncio.create_task(self.__monitor_lag())
+        try:
+            return await self.service_manager.arun(force)
+        finally:
+            monitor.cancel()
+
+    async def __monitor_lag(self):
+        """Sleep for lag_interval again and again, any extra delay is time the loop was too busy to wake us"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.lags.append(loop.time() - started_at - self.lag_interval)
+
+    def summary(self, top=10):
+        lines = [f'Scan took {self.wall_time:.2f}s, {self.sampler.count} stack samples '
+                 f'every {self.interval * 1000:g}ms']
+        if len(self.lags) > 0:
+            lags = sorted(self.lags)
+            lines.append(f'Event loop lag: mean {sum(lags) / len(lags) * 1000:.1f}ms, '
+                         f'p95 {lags[int(len(lags) * 0.95)] * 1000:.1f}ms, max {lags[-1] * 1000:.1f}ms')
+
+        lines += ['', 'Samples by service']
+        total = max(1, self.sampler.count)
+        for service, categories in sorted(self.sampler.categories.items(), key=lambda item: -sum(item[1].values())):
+            count = sum(categories.values())
+            breakdown = ', '.join(
+                f'{category} {samples * 100 / count:.0f}%'
+                for category, samples in sorted(categories.items(), key=lambda item: -item[1])
+            )
+            lines.append(f'  {service}: {count * 100 / total:.1f}% ({breakdown})')
+            leaves = sorted(self.sampler.leaves[service].items(), key=lambda item: -item[1])[:3]
+            for leaf, samples in leaves:
+                lines.append(f'    {samples * 100 / total:5.1f}%  {leaf}')
+
+        lines += ['', f'Top {top} functions by own time']
+        self.stats.sort_stats(pstats.SortKey.TIME)
+        for function in self.stats.fcn_list[:top]:
+            _, calls, own_time, cumulative_time, _ = self.stats.stats[function]
+            filename, line, name = function
+            lines.append(f'  {own_time:8.3f}s {cumulative_time:8.3f}s {calls:>9}  '
+                         f'{os.path.basename(filename)}:{line}({name})')
+
+        lines += ['', f'Profile written to {self.pstats_path}', f'Collapsed stacks written to {self.collapsed_path}']
+        return '\n'.join(lines)
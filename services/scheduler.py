@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from functools import partial
+
+
+class Scheduler:
+    """Run services as a dependency graph: each fetch starts as soon as the services it requires are done,
+    each join runs as soon as its own fetch and the services it requires are done"""
+
+    def __init__(self, services):
+        self.services = services
+
+    def resolve(self, names):
+        """Return names and all of their requirements, in dependency order"""
+        ordered = []
+        visiting = []
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f'Circular service dependency: {" -> ".join(visiting + [name])}')
+            if name not in self.services:
+                raise ValueError(f'Unknown service dependency: {name}')
+
+            visiting.append(name)
+            service = self.services[name]
+            for requirement in service.fetch_requires + service.join_requires:
+                visit(requirement)
+            visiting.pop()
+            ordered.append(name)
+
+        for name in names:
+            visit(name)
+        return ordered
+
+    async def run(self, names, roles, fetch=None, on_done=None, on_role=None):
+        """Run the services and their requirements, only the services listed in `fetch` (all by default)
+        download their data again, the others join the data they already hold.
+        on_done(name) is called when a service is joined, on_role(role) when every service joined the role"""
+        names = self.resolve(names)
+        done = {name: asyncio.Event() for name in names}
+        tracker = None
+        if on_role is not None:
+            tracker = RoleTracker(names, on_role)
+            for name in names:
+                self.services[name].on_role_joined = partial(tracker.joined, name)
+
+        async def run_service(name):
+            service = self.services[name]
+            if fetch is None or name in fetch:
+                for requirement in service.fetch_requires:
+                    await done[requirement].wait()
+
+                logging.debug(f'Fetching {service.name}')
+                with service.phase('fetch'):
+                    await service.fetch(roles)
+
+            for requirement in service.join_requires:
+                await done[requirement].wait()
+
+            logging.debug(f'Joining {service.name}')
+            with service.phase('join'):
+                service.join(roles)
+            done[name].set()
+            if tracker is not None:
+                for role in roles:
+                    tracker.joined(name, role)
+            if on_done is not None:
+                on_done(name)
+
+        # Tasks are named after their service, see services.profiler
+        tasks = [asyncio.create_task(run_service(name), name=self.services[name].name) for name in names]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other services too, the roles must not change once the failure is reported
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            for name in names:
+                self.services[name].on_role_joined = None
+
+
+class RoleTracker:
+    """Count the services which joined each role, to hand over every role as soon as it is complete"""
+
+    def __init__(self, names, on_role):
+        self.names = set(names)
+        self.on_role = on_role
+        self.joined_by_role = {}
+
+    def joined(self, name, role):
+        if not role.id in self.joined_by_role:
+            self.joined_by_role[role.id] = set()
+        joined = self.joined_by_role[role.id]
+        if name in joined:
+            return
+        joined.add(name)
+        if joined == self.names:
+            self.on_role(role)
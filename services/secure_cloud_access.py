@@ -1,74 +1,40 @@
-import asyncio
-import logging
-
-import aiohttp
-from tqdm.asyncio import tqdm_asyncio
-
 from objects.identity import SCAPolicy, SCAPolicyMember
-from services.service import Service, ServiceData
+from services.fetch_plan import FetchPlanService
+
 
+class SCAPoliciesService(FetchPlanService):
+    element_kind = 'policy'
+    data_name = 'SCA Policies'
+    unit = 'policy'
+    base_url = 'sca_url'
+    list_path = '/api/policies'
+    list_key = 'hits'
+    detail_path = '/api/policies/{id}'
+    role_types = ['role']
 
-class SCAPoliciesService(Service):
     def __init__(self, client):
         super().__init__('SCA Policies', client)
 
-    async def run(self, roles):
-        if not self.enabled:
-            logging.warning("Secure Cloud Access Service is disabled")
-            return roles
-
-        policies = await self.get_policies()
-        await asyncio.create_task(self.__load_policies_members(policies))
-
-        policies_by_role = {}
-        for policy in policies:
-            for member in policy.members:
-                if member.type == 'role':
-                    if not member.name in policies_by_role:
-                        policies_by_role[member.name] = []
-                    policies_by_role[member.name].append(policy)
-
-        for role in roles:
-            if not role.name in policies_by_role:
-                continue
-            role.services_data.append(ServiceData('SCA Policies', policies_by_role[role.name]))
-
-    async def get_policies(self):
-        async with aiohttp.ClientSession() as session:
-            headers = {'Content-Type': 'application/json'}
-            get_policies_req = await self.client.aget(
-                session,
-                f'https://{self.client.subdomain}.sca.cyberark.cloud/api/policies',
-                headers=headers
-            )
-
-            query = await get_policies_req.json()
-            policies_data = query['hits']
-            policies = []
-            for policy_data in policies_data:
-                policy = SCAPolicy(policy_data)
-                policies.append(policy)
-
-            return policies
-
-    async def __load_policies_members(self, policies):
-        async with aiohttp.ClientSession() as session:
-            await tqdm_asyncio.gather(
-                *[self.__load_policy_members(policy, session) for policy in policies],
-                desc="Loading SCA policy members",
-                unit='policy',
-                colour='#ffffff'
-            )
-
-    async def __load_policy_members(self, policy, session):
-        headers = {'Content-Type': 'application/json'}
-        request = await self.client.aget(
-            session,
-            f'https://{self.client.subdomain}.sca.cyberark.cloud/api/policies/{policy.id}',
-            headers=headers
-        )
-
-        logging.debug(f'Requesting SCA policy members {policy.id} --> GET {request.url}')
-        policy_members_data = await request.json()
-        for elm in policy_members_data['entities']:
-            policy.members.append(SCAPolicyMember(elm))
\ No newline at end of file
+    def item(self, item_data):
+        return SCAPolicy(item_data)
+
+    def read_detail(self, policy, policy_data):
+        policy.members = [SCAPolicyMember.from_data(elm) for elm in policy_data['entities']]
+
+    def edges(self, policy):
+        for member in policy.members:
+            yield member.type, member.name, policy, None
+
+    def dump_item(self, policy):
+        return {
+            'policyId': policy.id,
+            'name': policy.name,
+            'fingerprint': policy.fingerprint,
+            'entities': [{'entityName': member.name, 'entityClass': member.type} for member in policy.members],
+        }
+
+    def load_item(self, policy_data):
+        policy = SCAPolicy(policy_data)
+        policy.fingerprint = policy_data.get('fingerprint')
+        policy.members = [SCAPolicyMember.from_data(elm) for elm in policy_data['entities']]
+        return policy
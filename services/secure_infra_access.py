@@ -1,96 +1,62 @@
-import asyncio
-import logging
-
-import aiohttp
-from tqdm.asyncio import tqdm_asyncio
-
 from objects.identity import SIAPolicy, SIAPolicyRule, SIAPolicyRuleMember
-from services.service import Service, ServiceData
+from services.fetch_plan import FetchPlanService
+
 
+class SIAPoliciesService(FetchPlanService):
+    element_kind = 'policy'
+    data_name = 'SIA Policies'
+    unit = 'policy'
+    base_url = 'jit_url'
+    list_path = '/api/access-policies'
+    list_key = 'items'
+    detail_path = '/api/access-policies/{id}'
+    role_types = ['Role']
+    # Keys of the principals of a rule, and their member type
+    rule_principals = [('roles', 'Role'), ('users', 'User'), ('groups', 'Group')]
 
-class SIAPoliciesService(Service):
     def __init__(self, client):
         super().__init__('SIA Policies', client)
 
-    async def run(self, roles):
-        if not self.enabled:
-            logging.warning("Secure Infrastructure Access Service is disabled")
-            return roles
-
-        policies = await self.get_policies()
-        await asyncio.create_task(self.__load_policies_members(policies))
-
-        policyrules_by_role = {}
-        for policy in policies:
-            for rule in policy.rules:
-                for member in rule.members:
-                    if member.type == 'Role':
-                        if not member.name in policyrules_by_role:
-                            policyrules_by_role[member.name] = []
-                        policyrules_by_role[member.name].append((rule, policy))
-
-        for role in roles:
-            if not role.name in policyrules_by_role:
-                continue
-            data = []
-            for (rule, policy) in policyrules_by_role[role.name]:
-                data.append(rule)
-
-            role.services_data.append(ServiceData('SIA Policies', data))
-
-    async def get_policies(self):
-        async with aiohttp.ClientSession() as session:
-            headers = {'Content-Type': 'application/json'}
-            get_policies_req = await self.client.aget(
-                session,
-                f'https://{self.client.subdomain}-jit.cyberark.cloud/api/access-policies',
-                headers=headers
-            )
-
-            query = await get_policies_req.json()
-            policies_data = query['items']
-            policies = []
-            for policy_data in policies_data:
-                policy = SIAPolicy(policy_data)
-                policies.append(policy)
-
-            return policies
-
-    async def __load_policies_members(self, policies):
-        async with aiohttp.ClientSession() as session:
-            await tqdm_asyncio.gather(
-                *[self.__load_policy_members(policy, session) for policy in policies],
-                desc="Loading SIA policy members",
-                unit='policy',
-                colour='#ffffff'
-            )
-
-    async def __load_policy_members(self, policy, session):
-        headers = {'Content-Type': 'application/json'}
-        request = await self.client.aget(
-            session,
-            f'https://{self.client.subdomain}-jit.cyberark.cloud/api/access-policies/{policy.id}',
-            headers=headers
-        )
-
-        logging.debug(f'Requesting SIA policy members {policy.id} --> GET {request.url}')
-        policy_members_data = await request.json()
-        for rule_data in policy_members_data['userAccessRules']:
-            rule = SIAPolicyRule(rule_data, policy.name)
+    def item(self, item_data):
+        return SIAPolicy(item_data)
 
+    def read_detail(self, policy, policy_data):
+        policy.rules = []
+        for rule_data in policy_data['userAccessRules']:
             if not 'userData' in rule_data:
                 continue
 
-            if 'roles' in rule_data['userData']:
-                for role in rule_data['userData']['roles']:
-                    rule.members.append(SIAPolicyRuleMember(role['name'], 'Role'))
-
-            if 'users' in rule_data['userData']:
-                for user in rule_data['userData']['users']:
-                    rule.members.append(SIAPolicyRuleMember(user['name'], 'User'))
-
-            if 'groups' in rule_data['userData']:
-                for group in rule_data['userData']['groups']:
-                    rule.members.append(SIAPolicyRuleMember(group['name'], 'Group'))
-
-            policy.rules.append(rule)
\ No newline at end of file
+            rule = SIAPolicyRule(rule_data, policy.name)
+            for key, member_type in self.rule_principals:
+                for principal in rule_data['userData'].get(key, []):
+                    rule.members.append(SIAPolicyRuleMember.get(principal['name'], member_type))
+            policy.rules.append(rule)
+
+    def edges(self, policy):
+        for rule in policy.rules:
+            for member in rule.members:
+                # Rules are looked up by the name of their policy
+                yield member.type, member.name, rule, policy.name
+
+    def dump_item(self, policy):
+        return {
+            'policyId': policy.id,
+            'policyName': policy.name,
+            'fingerprint': policy.fingerprint,
+            'rules': [
+                {
+                    'ruleName': rule.name,
+                    'members': [{'name': member.name, 'type': member.type} for member in rule.members],
+                }
+                for rule in policy.rules
+            ],
+        }
+
+    def load_item(self, policy_data):
+        policy = SIAPolicy(policy_data)
+        policy.fingerprint = policy_data.get('fingerprint')
+        for rule_data in policy_data['rules']:
+            rule = SIAPolicyRule(rule_data, policy.name)
+            rule.members = [SIAPolicyRuleMember.get(elm['name'], elm['type']) for elm in rule_data['members']]
+            policy.rules.append(rule)
+        return policy
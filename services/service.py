@@ -1,10 +1,147 @@
+import asyncio
+import hashlib
+import json
+from contextlib import contextmanager
+
+from objects.index import JoinIndex
+from store.scan_store import Checkpoint
+
+# Fields of list responses which tell when an item last changed
+modification_keys = ['updatedOn', 'updatedAt', 'lastModified', 'lastModifiedDate', 'modifiedOn', 'updateDate']
+
+
+def fingerprint(item_data):
+    """Return a value which changes whenever the list item changes, its modification timestamp when the API
+    exposes one, a hash of the whole item otherwise"""
+    for key in modification_keys:
+        if item_data.get(key):
+            return f'{key}:{item_data[key]}'
+    return hashlib.sha1(json.dumps(item_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def create_task(coroutine):
+    """Create a task named after the current one, the task of the service which runs it, so the profiler
+    attributes the requests and parsing of the new task to that service"""
+    return asyncio.create_task(coroutine, name=asyncio.current_task().get_name())
+
+
+async def gather_tasks(tasks):
+    """Await the tasks and return their results. When one fails the others are cancelled before raising,
+    so a failed scan stops sending requests and checkpointing items while its partial results are shown"""
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        await cancel_tasks(tasks)
+        raise
+
+
+async def cancel_tasks(tasks):
+    """Cancel the tasks and wait until they stopped, discarding their results and exceptions"""
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Progress:
+    """Items a service loaded in detail so far, see 'scan status'"""
+
+    def __init__(self, unit, total=0):
+        self.unit = unit
+        self.total = total
+        self.done = 0
+
+
 class Service:
+    # Services whose results must be available before fetch() starts
+    fetch_requires = []
+    # Services whose results must be available before join() starts
+    join_requires = ['Roles']
+    # Seconds during which stored results are reused instead of fetched again
+    ttl = 3600
+    # Kind of the elements joined onto roles, to look them up with 'who <kind> <name>'
+    element_kind = None
+    # Hide the progress bars, eg: when scanning from a worker process
+    quiet = False
+    # Set by the scheduler to learn about roles joined ahead of join(), see role_joined()
+    on_role_joined = None
+
     def __init__(self, name, client):
         self.name = name
         self.client = client
         self.enabled = False
+        # Role <-> element edges of the last join
+        self.index = JoinIndex()
+        # Items finished by the scan in progress, replaced by the manager with one saved to the store
+        self.checkpoint = Checkpoint()
+        # Phases the service is in, innermost last, and the progress of its detail fetch, see 'scan status'
+        self.phases = []
+        self.progress = None
 
-    async def run(self, roles):
+    async def fetch(self, roles):
+        """Download the service data, roles may still be empty unless 'Roles' is in fetch_requires"""
+        pass
+
+    def join(self, roles):
+        """Attach the fetched data to the roles as ServiceData"""
+        pass
+
+    async def lookup(self, roles):
+        """Fetch the data these roles need, for 'cat' or 'grep role' before the service was scanned, see
+        ServiceManager.lookup(). Return True when the whole service data was fetched on the way, as most services
+        must list and detail every item to find those of a role. Services which can fetch one role override it"""
+        await self.fetch(roles)
+        return True
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the scan with 'with self.phase(name):', see 'stats' and 'scan status'"""
+        self.phases.append(name)
+        try:
+            with self.client.metrics.phase(self.name, name):
+                yield
+        finally:
+            self.phases.pop()
+
+    async def gather(self, coroutines, desc, unit):
+        """Run the coroutines concurrently behind a progress bar, see gather_tasks()"""
+        # Imported on first use, snapshots load this module for ServiceData alone
+        from tqdm import tqdm
+
+        tasks = [create_task(coroutine) for coroutine in coroutines]
+        self.progress = Progress(unit, len(tasks))
+        with tqdm(total=len(tasks), desc=desc, unit=unit, colour='#ffffff', disable=self.quiet) as progress:
+            def task_done(_):
+                self.progress.done += 1
+                progress.update()
+
+            for task in tasks:
+                task.add_done_callback(task_done)
+            try:
+                return await gather_tasks(tasks)
+            finally:
+                self.progress = None
+
+    def role_joined(self, role):
+        """Tell the scheduler this role was joined during fetch(), for services loading their data role by role,
+        so the role can be output before the whole service is done. join() must then skip this role"""
+        if self.on_role_joined is not None:
+            self.on_role_joined(role)
+
+    def grants(self, roles):
+        """Yield (principal type, principal name, service data name, element) for every element the fetched data
+        grants to a principal, roles included. 'Roles' grants make the principal a member of the element role"""
+        return []
+
+    def dump(self):
+        """Return the fetched data as JSON serializable objects, to be stored between scans"""
+        return None
+
+    def load(self, data):
+        """Restore the fetched data from the output of dump()"""
+        pass
+
+    def clear(self):
+        """Forget the fetched data, so the next fetch downloads everything again"""
         pass
 
     def enable(self):
@@ -15,9 +152,11 @@ class Service:
 
 
 class ServiceData:
+    __slots__ = ('name', 'data')
+
     def __init__(self, name, data):
         self.name = name
         self.data = data
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
@@ -0,0 +1,94 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import Manager
+from pathlib import Path
+from queue import Empty
+
+from dotenv import dotenv_values
+from tqdm import tqdm
+
+from api.client import CyberArkPlatformClient, RequestError
+from output.text import write_roles
+from services.manager import ServiceManager
+from services.scheduler import Scheduler
+from store.scan_store import ScanStore
+
+
+def scan_tenant(env_path, output_dir, settings, services, force, events):
+    """Worker process: log in with the credentials of env_path, scan the tenant and write its roles to output_dir.
+    Progress is reported as (env_path, event, value) tuples on the events queue"""
+    credentials = dotenv_values(env_path)
+    tenant_id = credentials.get('TENANT_ID')
+    if not tenant_id:
+        return env_path, 0, None, 'Missing TENANT_ID'
+
+    try:
+        client = CyberArkPlatformClient(tenant_id, credentials.get('CLIENT_ID'), credentials.get('CLIENT_SECRET'),
+                                        **settings)
+        asyncio.run(client.login())
+
+        service_manager = ServiceManager(client, ScanStore())
+        for name in services:
+            service_manager.enable(name)
+        for service in service_manager.services.values():
+            service.quiet = True
+
+        enabled = [name for name, service in service_manager.services.items() if service.enabled]
+        events.put((env_path, 'started', len(Scheduler(service_manager.services).resolve(enabled))))
+        roles = service_manager.run(force, on_done=lambda name: events.put((env_path, 'done', name)))
+
+        output_path = Path(output_dir) / f'{tenant_id}.txt'
+        with open(output_path, 'w', encoding='utf-8') as file:
+            write_roles(roles, file)
+        return tenant_id, len(roles), str(output_path), None
+    except (RequestError, OSError) as e:
+        return tenant_id, 0, None, str(e)
+
+
+def scan_tenants(env_paths, output_dir, workers, settings, services=('all',), force=False):
+    """Scan each tenant of env_paths in its own worker process, at most `workers` at a time.
+    Return (tenant id, roles count, output path, error) for each tenant"""
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    results = []
+    with Manager() as process_manager, ProcessPoolExecutor(max_workers=workers) as executor:
+        events = process_manager.Queue()
+        futures = {
+            executor.submit(scan_tenant, env_path, output_dir, settings, list(services), force, events): env_path
+            for env_path in env_paths
+        }
+
+        with tqdm(total=0, desc='Scanning tenants', unit='service', colour='#ffffff') as progress:
+            pending = set(futures)
+            while len(pending) > 0 or not events.empty():
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                report_events(events, progress)
+
+                for future in done:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # A crashed worker must not stop the other tenants
+                        result = (futures[future], 0, None, str(e))
+                    results.append(result)
+
+                    tenant_id, roles_count, output_path, error = result
+                    if error is None:
+                        progress.write(f'{tenant_id}: {roles_count} roles written to {output_path}')
+                    else:
+                        progress.write(f'{tenant_id}: scan failed: {error}')
+
+    return results
+
+
+def report_events(events, progress):
+    while True:
+        try:
+            env_path, event, value = events.get_nowait()
+        except Empty:
+            return
+
+        if event == 'started':
+            progress.total += value
+            progress.refresh()
+        elif event == 'done':
+            progress.update()
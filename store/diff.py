@@ -0,0 +1,84 @@
+import hashlib
+
+
+def element_key(element):
+    # Ids alone are not unique, eg: SIA rules are named the same in several policies
+    return f'{element.id}\0{element}'
+
+
+def role_hash(role):
+    """Return a 64 bits hash of the role's services data, the same for two scans granting the role the same elements"""
+    digest = hashlib.blake2b(digest_size=8)
+    for service_data in sorted(role.services_data, key=lambda service_data: service_data.name):
+        if len(service_data.data) == 0:
+            continue
+        digest.update(service_data.name.encode('utf-8') + b'\1')
+        for key in sorted(element_key(elm) for elm in service_data.data):
+            digest.update(key.encode('utf-8') + b'\2')
+    return int.from_bytes(digest.digest(), 'little')
+
+
+def role_hashes(roles):
+    """Return {role id: (position, hash)}, read from the file for the roles of a snapshot"""
+    if hasattr(roles, 'snapshot'):
+        return roles.snapshot.role_hashes()
+    return {role.id: (position, role_hash(role)) for position, role in enumerate(roles)}
+
+
+class RoleDiff:
+    """Elements granted to a role in one scan and not the other, by service data name"""
+    __slots__ = ('role', 'status', 'added', 'removed')
+
+    def __init__(self, role, status):
+        self.role = role
+        # 'added', 'removed' or 'changed'
+        self.status = status
+        self.added = {}
+        self.removed = {}
+
+
+def diff_roles(old_roles, new_roles):
+    """Compare two scans role by role, roles whose hash did not change are skipped without being read.
+    Return the RoleDiff of every added, removed or changed role, in the order of the new scan then the old one"""
+    old_hashes = role_hashes(old_roles)
+    new_hashes = role_hashes(new_roles)
+
+    diffs = []
+    for role_id, (position, new_hash) in sorted(new_hashes.items(), key=lambda item: item[1][0]):
+        if not role_id in old_hashes:
+            diffs.append(diff_role(None, new_roles[position], 'added'))
+        elif old_hashes[role_id][1] != new_hash:
+            diffs.append(diff_role(old_roles[old_hashes[role_id][0]], new_roles[position], 'changed'))
+
+    for role_id, (position, _) in sorted(old_hashes.items(), key=lambda item: item[1][0]):
+        if not role_id in new_hashes:
+            diffs.append(diff_role(old_roles[position], None, 'removed'))
+    return diffs
+
+
+def diff_role(old_role, new_role, status):
+    diff = RoleDiff(new_role if new_role is not None else old_role, status)
+    old_elements = elements_by_service(old_role)
+    new_elements = elements_by_service(new_role)
+
+    for name, elements in new_elements.items():
+        added = [elm for key, elm in elements.items() if key not in old_elements.get(name, {})]
+        if len(added) > 0:
+            diff.added[name] = added
+    for name, elements in old_elements.items():
+        removed = [elm for key, elm in elements.items() if key not in new_elements.get(name, {})]
+        if len(removed) > 0:
+            diff.removed[name] = removed
+    return diff
+
+
+def elements_by_service(role):
+    elements = {}
+    if role is None:
+        return elements
+    for service_data in role.services_data:
+        if not service_data.name in elements:
+            elements[service_data.name] = {}
+        for elm in service_data.data:
+            elements[service_data.name][element_key(elm)] = elm
+    return elements
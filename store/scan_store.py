@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+import time
+
+from api.auth import cache_directory
+
+
+class ScanStore:
+    """Local SQLite store of the data fetched by each service, one snapshot per tenant and service"""
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_directory().mkdir(mode=0o700, parents=True, exist_ok=True)
+            path = cache_directory() / 'scans.db'
+        self.path = path
+        # Scans may save from another thread than the one which opened the store,
+        # and tenants scanned in parallel processes share the same database
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS service_data (
+                tenant TEXT NOT NULL,
+                service TEXT NOT NULL,
+                scanned_at REAL NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (tenant, service)
+            )
+        ''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                tenant TEXT NOT NULL,
+                service TEXT NOT NULL,
+                item TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (tenant, service, item)
+            )
+        ''')
+        self.connection.commit()
+
+    def save(self, tenant, service, data, scanned_at=None):
+        if scanned_at is None:
+            scanned_at = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO service_data (tenant, service, scanned_at, data) VALUES (?, ?, ?, ?)',
+                (tenant, service, scanned_at, json.dumps(data, separators=(',', ':')))
+            )
+
+    def load(self, tenant, service):
+        """Return (scanned_at, data) of the last snapshot of the service, or (None, None)"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT scanned_at, data FROM service_data WHERE tenant = ? AND service = ?',
+                (tenant, service)
+            ).fetchone()
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def scanned_at(self, tenant):
+        """Return the snapshot timestamp of every stored service of the tenant"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT service, scanned_at FROM service_data WHERE tenant = ?',
+                (tenant,)
+            ).fetchall()
+        return dict(rows)
+
+    def delete(self, tenant, service=None):
+        with self.lock, self.connection:
+            if service is None:
+                self.connection.execute('DELETE FROM service_data WHERE tenant = ?', (tenant,))
+            else:
+                self.connection.execute('DELETE FROM service_data WHERE tenant = ? AND service = ?', (tenant, service))
+
+    def save_checkpoint(self, tenant, service, items):
+        """Add {item id: data} to the checkpoint of a service whose scan is in progress"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO checkpoint (tenant, service, item, data) VALUES (?, ?, ?, ?)',
+                [(tenant, service, item, json.dumps(data, separators=(',', ':'))) for item, data in items.items()]
+            )
+
+    def load_checkpoint(self, tenant, service):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT item, data FROM checkpoint WHERE tenant = ? AND service = ?',
+                (tenant, service)
+            ).fetchall()
+        return {item: json.loads(data) for item, data in rows}
+
+    def checkpointed(self, tenant):
+        """Return the services of the tenant with a checkpoint, left by scans which did not complete"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT DISTINCT service FROM checkpoint WHERE tenant = ?',
+                (tenant,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete_checkpoint(self, tenant, service):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM checkpoint WHERE tenant = ? AND service = ?', (tenant, service))
+
+    def close(self):
+        self.connection.close()
+
+
+class Checkpoint:
+    """Items a service finished during a scan, eg: safes whose members are loaded, written to the store as the scan
+    goes so 'scan --resume' skips them after a failure. Without a store the items are only kept in memory"""
+    # Items are written in batches, at most every flush_size items or flush_interval seconds
+    flush_size = 200
+    flush_interval = 2.0
+
+    def __init__(self, store=None, tenant=None, service=None, resume=False):
+        self.store = store
+        self.tenant = tenant
+        self.service = service
+        self.items = {}
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+        if store is not None:
+            if resume:
+                self.items = store.load_checkpoint(tenant, service)
+            else:
+                store.delete_checkpoint(tenant, service)
+
+    def get(self, item):
+        return self.items.get(item)
+
+    def save(self, item, data):
+        self.items[item] = data
+        if self.store is None:
+            return
+        self.pending[item] = data
+        if len(self.pending) >= self.flush_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.store is not None and len(self.pending) > 0:
+            self.store.save_checkpoint(self.tenant, self.service, self.pending)
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+
+    def clear(self):
+        """Forget the items once the service's results are saved"""
+        self.items = {}
+        self.pending = {}
+        if self.store is not None:
+            self.store.delete_checkpoint(self.tenant, self.service)
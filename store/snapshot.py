@@ -0,0 +1,333 @@
+import mmap
+import os
+import struct
+from array import array
+
+from objects.identity import Role
+from objects.index import NgramIndex
+from services.service import ServiceData
+from store.diff import role_hash
+
+magic = b'IGSNAP03'
+# String index of missing values, eg: a role without org path
+none = 0xFFFFFFFF
+# Sections of the file, in order. Each is an array of fixed width integers,
+# '_offsets' sections hold len + 1 prefix offsets into the next section
+sections = [
+    ('string_offsets', 'Q'),
+    ('strings', 'B'),
+    ('role_id', 'I'),
+    ('role_name', 'I'),
+    ('role_orgpath', 'I'),
+    ('role_hash', 'Q'),
+    ('role_group_offsets', 'I'),
+    ('group_name', 'I'),
+    ('group_edge_offsets', 'I'),
+    ('edges', 'I'),
+    ('element_id', 'I'),
+    ('element_name', 'I'),
+    ('element_display', 'I'),
+    ('element_type', 'I'),
+    ('element_policy', 'I'),
+    ('element_role_offsets', 'I'),
+    ('element_roles', 'I'),
+    ('grant_principal_type', 'I'),
+    ('grant_principal_name', 'I'),
+    ('grant_data_name', 'I'),
+    ('grant_element', 'I'),
+]
+# Magic, then the (offset, length) of each section
+header = struct.Struct('<8s' + 'QQ' * len(sections))
+
+
+def write_snapshot(path, roles, grants=()):
+    """Save the roles and their services data to path, see Snapshot. grants are those of the services, see
+    Service.grants(), the ones the roles do not record are saved too, eg: a safe granted to a user directly"""
+    columns = {name: array(typecode) for name, typecode in sections}
+    string_ids = {}
+    element_ids = {}
+    roles_by_element = []
+    blob = bytearray()
+    columns['string_offsets'].append(0)
+
+    def string(value):
+        if value is None:
+            return none
+        string_id = string_ids.get(value)
+        if string_id is None:
+            string_id = len(string_ids)
+            string_ids[value] = string_id
+            blob.extend(value.encode('utf-8'))
+            columns['string_offsets'].append(len(blob))
+        return string_id
+
+    def element(elm):
+        element_id = element_ids.get(id(elm))
+        if element_id is None:
+            element_id = len(element_ids)
+            element_ids[id(elm)] = element_id
+            columns['element_id'].append(string(elm.id))
+            columns['element_name'].append(string(elm.name))
+            columns['element_display'].append(string(str(elm)))
+            columns['element_type'].append(string(getattr(elm, 'type', None)))
+            columns['element_policy'].append(string(getattr(elm, 'policy_name', None)))
+            roles_by_element.append([])
+        return element_id
+
+    columns['role_group_offsets'].append(0)
+    columns['group_edge_offsets'].append(0)
+    joined = set()
+    for position, role in enumerate(roles):
+        columns['role_id'].append(string(role.id))
+        columns['role_name'].append(string(role.name))
+        columns['role_orgpath'].append(string(role.orgpath))
+        columns['role_hash'].append(role_hash(role))
+        for service_data in role.services_data:
+            columns['group_name'].append(string(service_data.name))
+            for elm in service_data.data:
+                element_id = element(elm)
+                columns['edges'].append(element_id)
+                roles_by_element[element_id].append(position)
+                joined.add((role.name, id(elm)))
+            columns['group_edge_offsets'].append(len(columns['edges']))
+        columns['role_group_offsets'].append(len(columns['group_name']))
+
+    # Role memberships and grants joined onto a role are read back from the roles, see Snapshot.grants()
+    for principal_type, principal_name, service_data_name, elm in grants:
+        if service_data_name == 'Roles' or (principal_name, id(elm)) in joined:
+            continue
+        columns['grant_principal_type'].append(string(principal_type))
+        columns['grant_principal_name'].append(string(principal_name))
+        columns['grant_data_name'].append(string(service_data_name))
+        columns['grant_element'].append(element(elm))
+
+    columns['element_role_offsets'].append(0)
+    for positions in roles_by_element:
+        columns['element_roles'].extend(sorted(set(positions)))
+        columns['element_role_offsets'].append(len(columns['element_roles']))
+    columns['strings'] = array('B', blob)
+
+    # Write next to the target and swap, an opened snapshot of the same file keeps its mapping
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as file:
+        offset = header.size
+        locations = []
+        for name, _ in sections:
+            # Align every section on 8 bytes
+            offset += -offset % 8
+            locations += [offset, len(columns[name])]
+            offset += len(columns[name]) * columns[name].itemsize
+        file.write(header.pack(magic, *locations))
+        for index, (name, _) in enumerate(sections):
+            file.write(b'\0' * (locations[index * 2] - file.tell()))
+            columns[name].tofile(file)
+    os.replace(temporary_path, path)
+
+
+class SnapshotElement:
+    """Element of a snapshot, standing for the safe, policy, member or webapp it was saved from"""
+    __slots__ = ('id', 'name', 'display', 'type', 'policy_name')
+
+    def __str__(self):
+        return self.display
+
+
+class Snapshot:
+    """Roles saved by write_snapshot(), read from a memory mapped file. Opening only maps the file,
+    a role and its services data are built the first time they are read. Also a drop-in for RoleIndex"""
+    # Kind of the elements of each service data, to look them up with 'who <kind> <name>'
+    element_kinds = {'Safes': 'safe', 'SIA Policies': 'policy', 'SCA Policies': 'policy', 'Web Apps': 'webapp'}
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < header.size or self.map[:len(magic)] != magic:
+            version = self.map[:len(magic)]
+            self.map.close()
+            if version[:-2] == magic[:-2]:
+                raise ValueError(f'{path} was saved in an older snapshot format, export it again')
+            raise ValueError(f'{path} is not an Identity Graph snapshot')
+
+        locations = header.unpack_from(self.map)[1:]
+        view = memoryview(self.map)
+        self.columns = {}
+        for index, (name, typecode) in enumerate(sections):
+            offset, length = locations[index * 2], locations[index * 2 + 1]
+            size = length * struct.calcsize(typecode)
+            if offset + size > len(self.map):
+                # Slicing past the end would give a short column rather than fail
+                for column in self.columns.values():
+                    column.release()
+                view.release()
+                self.map.close()
+                raise ValueError(f'{path} is truncated, export it again')
+            self.columns[name] = view[offset:offset + size].cast(typecode)
+
+        self.roles = SnapshotRoles(self)
+        self.elements = {}
+        self.by_name = None
+        self.by_id = None
+        self.role_names = None
+        self.data_names = None
+        self.element_data = None
+
+    def string(self, string_id):
+        if string_id == none:
+            return None
+        offsets = self.columns['string_offsets']
+        return str(self.columns['strings'][offsets[string_id]:offsets[string_id + 1]], 'utf-8')
+
+    def role(self, position):
+        columns = self.columns
+        role = Role({'Row': {
+            'ID': self.string(columns['role_id'][position]),
+            'Name': self.string(columns['role_name'][position]),
+            'OrgPath': self.string(columns['role_orgpath'][position]),
+        }})
+        group_offsets = columns['role_group_offsets']
+        edge_offsets = columns['group_edge_offsets']
+        for group in range(group_offsets[position], group_offsets[position + 1]):
+            edges = columns['edges'][edge_offsets[group]:edge_offsets[group + 1]]
+            role.services_data.append(ServiceData(
+                self.string(columns['group_name'][group]),
+                [self.element(element_id) for element_id in edges]
+            ))
+        return role
+
+    def role_hashes(self):
+        """Return {role id: (position, hash)} without building the roles, see store.diff"""
+        hashes = self.columns['role_hash']
+        return {
+            self.string(string_id): (position, hashes[position])
+            for position, string_id in enumerate(self.columns['role_id'])
+        }
+
+    def element(self, element_id):
+        """Return the element, the same instance for every role it is joined onto"""
+        elm = self.elements.get(element_id)
+        if elm is None:
+            elm = SnapshotElement()
+            elm.id = self.string(self.columns['element_id'][element_id])
+            elm.name = self.string(self.columns['element_name'][element_id])
+            elm.display = self.string(self.columns['element_display'][element_id])
+            # Only set for the elements which had them, like the objects they stand for
+            for attribute, column in [('type', 'element_type'), ('policy_name', 'element_policy')]:
+                if self.columns[column][element_id] != none:
+                    setattr(elm, attribute, self.string(self.columns[column][element_id]))
+            self.elements[element_id] = elm
+        return elm
+
+    def get(self, name_or_id):
+        """Return the roles with this name, or the role with this ID"""
+        if self.by_name is None:
+            self.by_name = {}
+            self.by_id = {}
+            for position in range(len(self.roles)):
+                name = self.string(self.columns['role_name'][position])
+                if not name in self.by_name:
+                    self.by_name[name] = []
+                self.by_name[name].append(position)
+                self.by_id[self.string(self.columns['role_id'][position])] = position
+
+        if name_or_id in self.by_name:
+            return [self.roles[position] for position in self.by_name[name_or_id]]
+        if name_or_id in self.by_id:
+            return [self.roles[self.by_id[name_or_id]]]
+        return []
+
+    def grep_roles(self, pattern):
+        if self.role_names is None:
+            self.role_names = NgramIndex()
+            for position in range(len(self.roles)):
+                self.role_names.add(self.string(self.columns['role_name'][position]), position)
+        return [self.roles[position] for position in sorted(self.role_names.search(pattern))]
+
+    def grep_data(self, pattern):
+        # Element names are searched once each, then mapped to the roles they are joined onto
+        if self.data_names is None:
+            self.data_names = NgramIndex()
+            for element_id in range(len(self.columns['element_name'])):
+                self.data_names.add(self.string(self.columns['element_name'][element_id]), element_id)
+
+        offsets = self.columns['element_role_offsets']
+        positions = set()
+        for element_id in self.data_names.search(pattern):
+            positions.update(self.columns['element_roles'][offsets[element_id]:offsets[element_id + 1]])
+        return [self.roles[position] for position in sorted(positions)]
+
+    def find(self, element_kind, name):
+        """Return (service data name, element) of the elements of this kind with this name, like
+        ServiceManager.find(). The elements are the ones grants() yields, so the access graph knows them"""
+        columns = self.columns
+        if self.element_data is None:
+            # Element id -> string id of the name of the service data it belongs to
+            self.element_data = {}
+            offsets = columns['group_edge_offsets']
+            for group in range(len(columns['group_name'])):
+                for element_id in columns['edges'][offsets[group]:offsets[group + 1]]:
+                    self.element_data[element_id] = columns['group_name'][group]
+            for grant in range(len(columns['grant_element'])):
+                self.element_data.setdefault(columns['grant_element'][grant], columns['grant_data_name'][grant])
+
+        results = []
+        for element_id, string_id in sorted(self.element_data.items()):
+            data_name = self.string(string_id)
+            if self.element_kinds.get(data_name) != element_kind:
+                continue
+            elm = self.element(element_id)
+            # SIA rules are looked up by the name of their policy, see JoinIndex.add()
+            if getattr(elm, 'policy_name', None) == name or elm.name == name:
+                results.append((data_name, elm))
+        return results
+
+    def grants(self, roles):
+        """Yield the grants recorded in the snapshot, the same as the services' grants(): the members of roles,
+        what roles are joined onto, then what is granted to other principals"""
+        for role in self.roles:
+            for service_data in role.services_data:
+                for elm in service_data.data:
+                    if service_data.name == 'Members':
+                        yield elm.type, elm.name, 'Roles', role
+                    else:
+                        yield 'Role', role.name, service_data.name, elm
+
+        columns = self.columns
+        for grant in range(len(columns['grant_element'])):
+            yield (
+                self.string(columns['grant_principal_type'][grant]),
+                self.string(columns['grant_principal_name'][grant]),
+                self.string(columns['grant_data_name'][grant]),
+                self.element(columns['grant_element'][grant]),
+            )
+
+    def close(self):
+        # The map can only be closed once no view of it is left
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.map.close()
+
+
+class SnapshotRoles:
+    """Sequence of the roles of a snapshot, each role is built on first access then kept"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.roles = [None] * len(snapshot.columns['role_id'])
+
+    def __len__(self):
+        return len(self.roles)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[index] for index in range(*position.indices(len(self.roles)))]
+        role = self.roles[position]
+        if role is None:
+            role = self.snapshot.role(position)
+            self.roles[position] = role
+        return role
+
+    def __iter__(self):
+        for position in range(len(self.roles)):
+            yield self[position]